@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 import configparser
+import functools
+import hashlib
+import io
 import os
 import random
 import subprocess
@@ -24,14 +27,207 @@ highest_tank_sensor_idx_in_file = -1
 highest_virtual_battery_idx_in_file = -1
 highest_pv_charger_idx_in_file = -1
 discovered_modules_and_topics_global = {}
-
+# EXTERNAL_DEVICES_NONINTERACTIVE=1 answers every value, count, type and yes/no prompt with an empty answer,
+# i.e. keeps the current/default value and declines confirmations and discovery. Only the menu choices
+# (service, main, add/edit/remove device and configuration file menus) are still read from stdin, and
+# end-of-input there exits the script instead of blocking.
+NONINTERACTIVE = os.environ.get('EXTERNAL_DEVICES_NONINTERACTIVE') == '1'
+# [Global] device counter key for each removable device type
+GLOBAL_DEVICE_COUNT_KEYS = {
+    'relay': 'numberofmodules',
+    'temp': 'numberoftempsensors',
+    'tank': 'numberoftanksensors',
+    'battery': 'numberofvirtualbatteries',
+    'pv': 'numberofpvchargers',
+}
+# Discovery ends early once no new module or topic has been seen for this long; the cap bounds slow publishers
+DISCOVERY_QUIET_SECONDS = 5.0
+DISCOVERY_MAX_SECONDS = 60
+discovery_last_new_ts = 0.0
+
+# Discovery topic patterns, compiled once since every message seen during discovery is checked against them
+# Dingtian: Flexible 'dingtian' path segment, then 'relay[alphanumeric]', then optional path, then either
+# 'out/i[digits]' (digital input) or 'out'|'in' then 'r[digits]' (relay output state/command), in one search
+DINGTIAN_RE = re.compile(r'(?:^|.*/)(?P<base>[a-zA-Z0-9_-]*dingtian[a-zA-Z0-9_-]*)/(?P<serial>relay[a-zA-Z0-9]+)/(?:.*/)?'
+                         r'(?:out/i(?P<input_id>[0-9]+)|(?P<direction>out|in)/r(?P<relay_id>[0-9]+))$')
+# Shelly: broad path matching, case-insensitive
+SHELLY_RE = re.compile(r'(?:^|.*/)(shelly[a-zA-Z0-9_-]+)(?:/.*)?/status/switch:([0-9]+)$', re.IGNORECASE)
+
+# Topic filters used during discovery, so the broker only forwards topics that can match the patterns above.
+# Dingtian publishes under a 'dingtian' level (often with a leading '/'); Shelly Gen2 devices publish
+# '<device id>/status/switch:N', optionally below a user prefix.
+DISCOVERY_TOPIC_FILTERS = [
+    ("dingtian/#", 0),
+    ("+/dingtian/#", 0),
+    ("+/+/dingtian/#", 0),
+    ("+/status/+", 0),
+    ("+/+/status/+", 0),
+    ("+/+/+/status/+", 0),
+]
+# Devices publishing deeper than the filters above are only seen on a full '#' subscription; discovery
+# falls back to it when the filtered subscription has found nothing after this many seconds
+DISCOVERY_FALLBACK_FILTER = ("#", 0)
+DISCOVERY_FALLBACK_AFTER_SECONDS = 10.0
+
+
+# (mtime, size) of each config file as last read into or written from memory
+_CFG_CACHE = {}
+
+def _config_file_key(config_path):
+    st = os.stat(config_path)
+    return (st.st_mtime_ns, st.st_size)
+
+def load_config(config, config_path):
+    """Reads config_path into config, unless the file is unchanged since it was last read or saved."""
+    try:
+        key = _config_file_key(config_path)
+    except FileNotFoundError:
+        return # Nothing saved yet; config.read() would skip a missing file too
+    if _CFG_CACHE.get(config_path) == key:
+        return
+    config.read(config_path)
+    _CFG_CACHE[config_path] = key
+
+def save_config(config, config_path):
+    """Writes config to config_path and remembers the result, so the next load can skip re-reading it."""
+    # Render in memory first so the file gets one write() instead of one per line
+    buf = io.StringIO()
+    config.write(buf)
+    # Write to a temp file and rename over the original, so a crash mid-write never leaves a truncated config
+    tmp_path = config_path + '.tmp'
+    with open(tmp_path, 'w') as configfile:
+        configfile.write(buf.getvalue())
+        # Make the data durable before the rename, or a power cut can leave an empty file behind it
+        configfile.flush()
+        os.fsync(configfile.fileno())
+    os.replace(tmp_path, config_path)
+    _CFG_CACHE[config_path] = _config_file_key(config_path)
 
 # --- Existing functions (unchanged) ---
 def generate_serial():
     """Generates a random 16-digit serial number."""
     return ''.join([str(random.randint(0, 9)) for _ in range(16)])
 
+def config_digest(config_path):
+    """Returns a hash of the config file contents, or None if the file doesn't exist."""
+    try:
+        with open(config_path, 'rb') as configfile:
+            return hashlib.blake2b(configfile.read(), digest_size=16).digest()
+    except FileNotFoundError:
+        return None
+
+def _fast_input(prompt=''):
+    """input() without its extra stderr/stdout flushes: one write and flush of the prompt, then one readline."""
+    if prompt:
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line[:-1] if line.endswith('\n') else line
+
+def _ask(prompt):
+    """Reads the answer to a non-menu prompt; returns '' without asking when NONINTERACTIVE."""
+    if NONINTERACTIVE:
+        return ''
+    return _fast_input(prompt)
+
+def prompt_value(prompt, current_value):
+    """Asks for a value, showing the current one, and returns the answer or the current value if left empty."""
+    if NONINTERACTIVE:
+        return current_value
+    return _fast_input(f"{prompt} (current: {current_value}): ") or current_value
+
+def ensure_serial(config, section, data_from_file, label):
+    """Keeps the serial from the file, or generates and announces a new one, and stores it in the section."""
+    serial = data_from_file.get('serial')
+    if not serial:
+        serial = generate_serial()
+        print(f"Generated new serial for {label}: {serial}")
+    config.set(section, 'serial', serial)
+    return serial
+
+def prompt_and_set(config, section, data_from_file, field_specs, idx):
+    """
+    Prompts for each (key, prompt, default) in field_specs and stores the answer in the section.
+    An empty answer keeps the value from the file, or the default for a new device.
+    '{idx}' in a prompt is replaced by the device index.
+    """
+    values = {}
+    for key, prompt, default in field_specs:
+        current_value = data_from_file.get(key, default)
+        # Only the '(current: ...)' tail changes per device; static prompts skip str.format
+        prefix = prompt.format(idx=idx) if '{idx}' in prompt else prompt
+        values[key] = prompt_value(prefix, current_value)
+    # Store all answers with one update of the section instead of a set() per field
+    config.read_dict({section: values})
+
+# --- Selectable device types, with their option lists formatted once for the prompts ---
+INPUT_TYPES = ('disabled', 'door alarm', 'bilge pump', 'bilge alarm', 'burglar alarm', 'smoke alarm', 'fire alarm', 'CO2 alarm')
+INPUT_TYPES_DISPLAY = ', '.join(INPUT_TYPES)
+# Answers are lowercased before the membership check, so the sets hold lowercased names
+INPUT_TYPES_SET = frozenset(input_type.lower() for input_type in INPUT_TYPES)
+TEMP_SENSOR_TYPES = ('battery', 'fridge', 'room', 'outdoor', 'water heater', 'freezer', 'generic')
+TEMP_SENSOR_TYPES_DISPLAY = ', '.join(TEMP_SENSOR_TYPES)
+TEMP_SENSOR_TYPES_SET = frozenset(TEMP_SENSOR_TYPES)
+FLUID_TYPES = {
+    'fuel': 0, 'fresh water': 1, 'waste water': 2, 'live well': 3,
+    'oil': 4, 'black water': 5, 'gasoline': 6, 'diesel': 7,
+    'lpg': 8, 'lng': 9, 'hydraulic oil': 10, 'raw water': 11
+}
+FLUID_TYPES_DISPLAY = ", ".join(f"'{name}'" for name in FLUID_TYPES)
+
+# --- Prompted fields per device type, as (key, prompt, default) ---
+RELAY_MODULE_PAYLOAD_FIELDS = (
+    ('mqtt_on_state_payload', "Enter MQTT ON state payload for Relay Module {idx}", 'ON'),
+    ('mqtt_off_state_payload', "Enter MQTT OFF state payload for Relay Module {idx}", 'OFF'),
+    ('mqtt_on_command_payload', "Enter MQTT ON command payload for Relay Module {idx}", 'ON'),
+    ('mqtt_off_command_payload', "Enter MQTT OFF command payload for Relay Module {idx}", 'OFF'),
+)
+TEMP_SENSOR_TOPIC_FIELDS = (
+    ('temperaturestatetopic', "Enter MQTT temperature state topic for Temperature Sensor {idx}", 'path/to/mqtt/topic'),
+    ('humiditystatetopic', "Enter MQTT humidity state topic for Temperature Sensor {idx}", 'path/to/mqtt/topic'),
+    ('batterystatetopic', "Enter MQTT battery state topic for Temperature Sensor {idx}", 'path/to/mqtt/topic'),
+)
+TANK_SENSOR_TOPIC_FIELDS = (
+    ('levelstatetopic', "Enter MQTT level state topic for Tank Sensor {idx}", 'path/to/mqtt/topic'),
+    ('batterystatetopic', "Enter MQTT battery state topic for Tank Sensor {idx}", 'path/to/mqtt/topic'),
+    ('temperaturestatetopic', "Enter MQTT temperature state topic for Tank Sensor {idx}", 'path/to/mqtt/topic'),
+    ('rawvaluestatetopic', "Enter MQTT raw value state topic for Tank Sensor {idx}", 'path/to/mqtt/topic'),
+)
+TANK_SENSOR_CALIBRATION_FIELDS = (
+    ('rawvalueempty', "Enter raw value for empty tank", '0'),
+    ('rawvaluefull', "Enter raw value for full tank", '240'),
+    ('capacity', "Enter tank capacity in m³", '0.2'),
+)
+VIRTUAL_BATTERY_FIELDS = (
+    ('capacityah', "Enter capacity for Virtual Battery {idx} in Ah", '100'),
+    ('currentstatetopic', "Enter MQTT battery current state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('powerstatetopic', "Enter MQTT battery power state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('temperaturestatetopic', "Enter MQTT temperature state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('voltagestatetopic', "Enter MQTT voltage state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('maxchargecurrentstatetopic', "Enter MQTT max charge current state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('maxchargevoltagestatetopic', "Enter MQTT max charge voltage state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('maxdischargecurrentstatetopic', "Enter MQTT max discharge current state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('socstatetopic', "Enter MQTT SOC state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+    ('sohstatetopic', "Enter MQTT SOH state topic for Virtual Battery {idx}", 'path/to/mqtt/topic'),
+)
+PV_CHARGER_TOPIC_FIELDS = (
+    ('batterycurrentstatetopic', "Enter MQTT topic for battery current", 'path/to/mqtt/topic'),
+    ('batteryvoltagestatetopic', "Enter MQTT topic for battery voltage", 'path/to/mqtt/topic'),
+    ('maxchargecurrentstatetopic', "Enter MQTT topic for max charge current", 'path/to/mqtt/topic'),
+    ('maxchargevoltagestatetopic', "Enter MQTT topic for max charge voltage", 'path/to/mqtt/topic'),
+    ('pvvoltagestatetopic', "Enter MQTT topic for PV voltage", 'path/to/mqtt/topic'),
+    ('pvpowerstatetopic', "Enter MQTT topic for PV power", 'path/to/mqtt/topic'),
+    ('chargerstatetopic', "Enter MQTT topic for charger state", 'path/to/mqtt/topic'),
+    ('loadstatetopic', "Enter MQTT topic for load state", 'path/to/mqtt/topic'),
+    ('totalyield', "Enter MQTT topic for total user accumulated yield", 'path/to/mqtt/topic'),
+    ('systemyield', "Enter MQTT topic for total system accumulated yield", 'path/to/mqtt/topic'),
+)
+
 # --- MQTT Callbacks for Discovery ---
+# Discovered topics are parsed once in on_message and again while auto-configuring each switch and input
+@functools.lru_cache(maxsize=4096)
 def parse_mqtt_device_topic(topic):
     """
     Parses MQTT topics to extract device information (Dingtian or Shelly).
@@ -44,36 +240,38 @@ def parse_mqtt_device_topic(topic):
     component_id: 'r1', '0' (for shelly relay 0), None for general device topics
     full_topic_base: The base path for the device, e.g., 'dingtian/relay1a76f' or 'shellyplus1pm-08f9e0fe4034'
     """
-    logger.debug(f"Attempting to parse topic: {topic}")
-
-    # NEW: Dingtian Input Regex: Flexible 'dingtian' path segment, then 'relay[alphanumeric]', then optional path, then 'out/i[digits]'
-    # User specified that 'out/ix' topics are for digital inputs.
-    dingtian_input_match = re.search(r'(?:^|.*/)([a-zA-Z0-9_-]*dingtian[a-zA-Z0-9_-]*)/(relay[a-zA-Z0-9]+)/(?:.*/)?out/i([0-9]+)$', topic)
-    if dingtian_input_match:
-        path_segment_with_dingtian = dingtian_input_match.group(1)
-        module_serial = dingtian_input_match.group(2)
-        full_topic_base = f"{path_segment_with_dingtian}/{module_serial}"
-        logger.debug(f"Matched Dingtian Input (out/iX): Type=dingtian, Serial={module_serial}, ComponentType=in, ComponentID={dingtian_input_match.group(3)}, Base={full_topic_base}")
-        return 'dingtian', module_serial, 'in', dingtian_input_match.group(3), full_topic_base
+    logger.debug("Attempting to parse topic: %s", topic)
 
+    # Cheap substring checks first, so the regexes only run on candidate topics.
+    # The Dingtian patterns are case-sensitive, the Shelly pattern is not.
+    is_dingtian_candidate = 'dingtian' in topic
+    is_shelly_candidate = 'shelly' in topic.lower()
+    if not is_dingtian_candidate and not is_shelly_candidate:
+        logger.debug("No Dingtian or Shelly pattern matched.")
+        return None, None, None, None, None
 
-    # Existing Dingtian Output/Input Regex: Flexible 'dingtian' path segment, then 'relay[alphanumeric]', then optional path, then 'out'|'in', then 'r[digits]'
-    dingtian_match = re.search(r'(?:^|.*/)([a-zA-Z0-9_-]*dingtian[a-zA-Z0-9_-]*)/(relay[a-zA-Z0-9]+)/(?:.*/)?(out|in)/r([0-9]+)$', topic)
+    dingtian_match = DINGTIAN_RE.search(topic) if is_dingtian_candidate else None
     if dingtian_match:
-        path_segment_with_dingtian = dingtian_match.group(1)
-        module_serial = dingtian_match.group(2)
-        full_topic_base = f"{path_segment_with_dingtian}/{module_serial}"
-        logger.debug(f"Matched Dingtian (out/in/rX): Type=dingtian, Serial={module_serial}, ComponentType={dingtian_match.group(3)}, ComponentID={dingtian_match.group(4)}, Base={full_topic_base}")
-        return 'dingtian', module_serial, dingtian_match.group(3), dingtian_match.group(4), full_topic_base
+        module_serial = dingtian_match['serial']
+        full_topic_base = f"{dingtian_match['base']}/{module_serial}"
+        # User specified that 'out/ix' topics are for digital inputs.
+        if dingtian_match['input_id'] is not None:
+            component_type, component_id = 'in', dingtian_match['input_id']
+        else:
+            component_type, component_id = dingtian_match['direction'], dingtian_match['relay_id']
+        logger.debug("Matched Dingtian: Type=dingtian, Serial=%s, ComponentType=%s, ComponentID=%s, Base=%s",
+                     module_serial, component_type, component_id, full_topic_base)
+        return 'dingtian', module_serial, component_type, component_id, full_topic_base
 
     # Shelly Regex (Updated for broader path matching and case-insensitivity)
-    shelly_match = re.search(r'(?:^|.*/)(shelly[a-zA-Z0-9_-]+)(?:/.*)?/status/switch:([0-9]+)$', topic, re.IGNORECASE)
+    shelly_match = SHELLY_RE.search(topic) if is_shelly_candidate else None
     if shelly_match:
         module_serial = shelly_match.group(1)
         full_topic_base = module_serial
         component_id = shelly_match.group(2)
         component_type = 'relay'
-        logger.debug(f"Matched Shelly: Type=shelly, Serial={module_serial}, ComponentType={component_type}, Component_ID={component_id}, Base={full_topic_base}")
+        logger.debug("Matched Shelly: Type=shelly, Serial=%s, ComponentType=%s, Component_ID=%s, Base=%s",
+                     module_serial, component_type, component_id, full_topic_base)
         return 'shelly', module_serial, component_type, component_id, full_topic_base
 
     logger.debug("No Dingtian or Shelly pattern matched.")
@@ -81,14 +279,15 @@ def parse_mqtt_device_topic(topic):
 
 def on_connect(client, userdata, flags, rc):
     print(f"Connected to MQTT broker with result code {rc}")
-    client.subscribe("#")
-    print("Subscribed to '#' for device discovery, will filter for 'dingtian' or 'shelly' in topics.")
+    client.subscribe(DISCOVERY_TOPIC_FILTERS)
+    print("Subscribed to Dingtian and Shelly topic filters for device discovery.")
     print("Please wait....Listening for devices....")
 
 def on_message(client, userdata, msg):
     """Callback for when a PUBLISH message is received from the server."""
+    global discovery_last_new_ts
     topic = msg.topic
-    logger.debug(f"Received MQTT message on topic: {topic}")
+    logger.debug("Received MQTT message on topic: %s", topic)
     device_type, module_serial, component_type, component_id, full_topic_base = parse_mqtt_device_topic(topic)
 
     if module_serial:
@@ -98,23 +297,26 @@ def on_message(client, userdata, msg):
                 "topics": set(),
                 "base_topic_path": full_topic_base
             }
-            logger.debug(f"Discovered new module: {device_type} with serial {module_serial}")
-        discovered_modules_and_topics_global[module_serial]["topics"].add(topic)
-        logger.debug(f"Added topic {topic} to module {module_serial}")
+            logger.debug("Discovered new module: %s with serial %s", device_type, module_serial)
+        module_topics = discovered_modules_and_topics_global[module_serial]["topics"]
+        if topic not in module_topics:
+            module_topics.add(topic)
+            discovery_last_new_ts = time.monotonic()
+            logger.debug("Added topic %s to module %s", topic, module_serial)
     else:
-        logger.debug(f"Topic '{topic}' did not match any known device patterns.")
+        logger.debug("Topic '%s' did not match any known device patterns.", topic)
 
 # --- Modified Function for MQTT Connection and Discovery ---
 def get_mqtt_broker_info(current_broker_address=None, current_port=None, current_username=None, current_password=None):
     """Prompts user for MQTT broker details, showing existing values as defaults."""
     print("\n--- MQTT Broker Configuration ---")
 
-    broker_address = input(f"Enter MQTT broker address (current: {current_broker_address if current_broker_address else 'localhost'}): ") or (current_broker_address if current_broker_address else '')
-    port = input(f"Enter MQTT port (current: {current_port if current_port else '1883'}): ") or (current_port if current_port else '1883')
-    username = input(f"Enter MQTT username (current: {current_username if current_username else 'not set'}; leave blank if none): ") or (current_username if current_username else '')
+    broker_address = _ask(f"Enter MQTT broker address (current: {current_broker_address if current_broker_address else 'localhost'}): ") or (current_broker_address if current_broker_address else '')
+    port = _ask(f"Enter MQTT port (current: {current_port if current_port else '1883'}): ") or (current_port if current_port else '1883')
+    username = _ask(f"Enter MQTT username (current: {current_username if current_username else 'not set'}; leave blank if none): ") or (current_username if current_username else '')
 
     password_display = '******' if current_password else 'not set'
-    password = input(f"Enter MQTT password (current: {password_display}; leave blank if none): ") or (current_password if current_password else '')
+    password = _ask(f"Enter MQTT password (current: {password_display}; leave blank if none): ") or (current_password if current_password else '')
 
     return broker_address, int(port), username if username else None, password if password else None
 
@@ -122,8 +324,10 @@ def discover_devices_via_mqtt(client):
     """
     Connects to MQTT broker and attempts to discover Dingtian and Shelly devices by listening to topics.
     """
-    global discovered_modules_and_topics_global
+    global discovered_modules_and_topics_global, discovery_last_new_ts
     discovered_modules_and_topics_global.clear()
+    parse_mqtt_device_topic.cache_clear()
+    discovery_last_new_ts = 0.0
 
     print("\nAttempting to discover Dingtian and Shelly devices via MQTT by listening to topics...")
     print(" (This requires devices to be actively publishing data on topics containing 'dingtian' or 'shelly'.)")
@@ -133,47 +337,79 @@ def discover_devices_via_mqtt(client):
 
     client.loop_start()
 
-    discovery_duration = 60
-    print(f"Listening for messages for {discovery_duration} seconds...")
-    time.sleep(discovery_duration)
+    print(f"Listening for messages for up to {DISCOVERY_MAX_SECONDS} seconds...")
+    # Retained states arrive right after subscribing, so stop once the discovered set has been quiet for a while
+    start_ts = time.monotonic()
+    fallback_subscribed = False
+    while True:
+        time.sleep(0.5)
+        now = time.monotonic()
+        if now - start_ts >= DISCOVERY_MAX_SECONDS:
+            break
+        if discovered_modules_and_topics_global and now - discovery_last_new_ts > DISCOVERY_QUIET_SECONDS:
+            logger.debug("No new devices for %s seconds, ending discovery early.", DISCOVERY_QUIET_SECONDS)
+            break
+        if not discovered_modules_and_topics_global and not fallback_subscribed and now - start_ts >= DISCOVERY_FALLBACK_AFTER_SECONDS:
+            print("No devices found on the usual Dingtian/Shelly topics yet, listening on all topics...")
+            client.subscribe([DISCOVERY_FALLBACK_FILTER])
+            fallback_subscribed = True
 
     client.loop_stop()
 
     print(f"Found {len(discovered_modules_and_topics_global)} potential Dingtian/Shelly modules.")
     return discovered_modules_and_topics_global
 
-def service_options_menu():
-    print("\n--- Service Options ---")
-    print("1) Install and activate service")
-    print("2) Restart service (Populate configuration changes")
-    print("3) Quit and exit")
-
-    choice = input("Enter your choice (1, 2, or 3): ")
-
-    if choice == '1':
-        print("Running: /data/external-devices/setup install")
-        try:
-            subprocess.run(['/data/external-devices/setup', 'install'], check=True)
-            print("Service installed and activated successfully.")
-                
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error installing service or rebooting: {e}")
-        except FileNotFoundError:
-            logger.error("Error: '/data/external-devices/setup' command not found. Please ensure the setup script exists.")
-    elif choice == '2':
-        print("Restarting service")
-        try:
-            subprocess.run(['svc', '-t', '/service/external_devices'], check=True)
-            print("Service restarted successfully.")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error restarting service: {e}")
-        except FileNotFoundError:
-            logger.error("Error: service not found.")
-    elif choice == '3':
-        print("Exiting script.")
-        exit()
-    else:
+def install_service():
+    print("Running: /data/external-devices/setup install")
+    try:
+        subprocess.run(['/data/external-devices/setup', 'install'], check=True)
+        print("Service installed and activated successfully.")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error installing service or rebooting: {e}")
+    except FileNotFoundError:
+        logger.error("Error: '/data/external-devices/setup' command not found. Please ensure the setup script exists.")
+
+def restart_service():
+    print("Restarting service")
+    try:
+        subprocess.run(['svc', '-t', '/service/external_devices'], check=True)
+        print("Service restarted successfully.")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error restarting service: {e}")
+    except FileNotFoundError:
+        logger.error("Error: service not found.")
+
+def quit_script():
+    print("Exiting script.")
+    exit()
+
+SERVICE_MENU_TEXT = (
+    "\n--- Service Options ---\n"
+    "1) Install and activate service\n"
+    "2) Restart service (Populate configuration changes\n"
+    "3) Quit and exit"
+)
+# Service menu choice -> action
+SERVICE_MENU_HANDLERS = {
+    '1': install_service,
+    '2': restart_service,
+    '3': quit_script,
+}
+
+def service_options_menu(config_changed=True):
+    print(SERVICE_MENU_TEXT)
+
+    choice = _fast_input("Enter your choice (1, 2, or 3): ")
+
+    handler = SERVICE_MENU_HANDLERS.get(choice)
+    if handler is None:
         print("Invalid choice. Please enter 1, 2, or 3.")
+        return
+    # A restart only picks up configuration changes, so skip it when the file is the same as at startup
+    if handler is restart_service and not config_changed:
+        print("Configuration unchanged, no restart needed.")
+        return
+    handler()
 
 def configure_relay_module(config, existing_relay_modules_by_index, existing_switches_by_module_and_switch_idx,
                            existing_inputs_by_module_and_input_idx, device_instance_counter, device_index_sequencer,
@@ -202,17 +438,16 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
 
     # Check if this slot should be auto-configured from discovery results
     if is_new_device_flow and auto_configured_serials_to_info:
+        # We need to ensure the auto_serial_key isn't already used in any existing Relay_Module_X in the config
+        # (checked by `moduleserial` field, or if `serial` field happened to be the discovered serial)
+        used_serials_in_config = frozenset(
+            serial
+            for existing_mod_data in existing_relay_modules_by_index.values()
+            for serial in (existing_mod_data.get('moduleserial'), existing_mod_data.get('serial'))
+        )
         # Try to find an un-used auto-discovered serial for this new module slot
-        for auto_serial_key in sorted(auto_configured_serials_to_info.keys()):
-            # We need to ensure this auto_serial_key isn't already used in any existing Relay_Module_X in the config
-            # (checked by `moduleserial` field, or if `serial` field happened to be the discovered serial)
-            already_used_in_config = False
-            for existing_mod_data in existing_relay_modules_by_index.values():
-                if (existing_mod_data.get('moduleserial') == auto_serial_key or
-                    existing_mod_data.get('serial') == auto_serial_key):
-                    already_used_in_config = True
-                    break
-            if not already_used_in_config:
+        for auto_serial_key in sorted(auto_configured_serials_to_info):
+            if auto_serial_key not in used_serials_in_config:
                 current_serial = generate_serial() # Keep the 'serial' field as a random, unique ID
                 discovered_module_serial_for_slot = auto_serial_key # Store the actual discovered serial here
                 module_info_from_discovery = auto_configured_serials_to_info[auto_serial_key]
@@ -224,6 +459,14 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
         current_serial = generate_serial()
         logger.debug(f"Generated new serial {current_serial} for Relay Module slot {module_idx}.")
 
+    # Index the discovered topics of this module once by (component_type, component_id)
+    discovered_topic_index = {}
+    if is_auto_configured_for_this_slot and module_info_from_discovery:
+        for t in module_info_from_discovery['topics']:
+            parsed_type, parsed_serial, parsed_comp_type, parsed_comp_id, _ = parse_mqtt_device_topic(t)
+            if parsed_serial == discovered_module_serial_for_slot and parsed_comp_id:
+                discovered_topic_index.setdefault((parsed_comp_type, parsed_comp_id), t)
+
     if not config.has_section(relay_module_section):
         config.add_section(relay_module_section)
 
@@ -255,29 +498,20 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
     if is_auto_configured_for_this_slot and module_info_from_discovery:
         config.set(relay_module_section, 'customname', f"{module_info_from_discovery['device_type'].capitalize()} Module {module_idx}")
     else:
-        config.set(relay_module_section, 'customname', input(f"Enter custom name for Relay Module {module_idx} (current: {current_custom_name}): ") or current_custom_name)
+        config.set(relay_module_section, 'customname', prompt_value(f"Enter custom name for Relay Module {module_idx}", current_custom_name))
 
     current_num_switches_for_module = module_data_from_file.get('numberofswitches', 4)
     if is_auto_configured_for_this_slot and module_info_from_discovery:
+        # The topic index already holds one entry per discovered component
         if module_info_from_discovery['device_type'] == 'dingtian':
-            dingtian_out_switches = set()
-            for t in module_info_from_discovery['topics']:
-                parsed_type, parsed_serial, comp_type, comp_id, _ = parse_mqtt_device_topic(t)
-                if parsed_serial == discovered_module_serial_for_slot and comp_type == 'out' and comp_id:
-                    dingtian_out_switches.add(comp_id)
-            num_switches = len(dingtian_out_switches) if dingtian_out_switches else 1
+            num_switches = sum(1 for comp_type, _ in discovered_topic_index if comp_type == 'out') or 1
         elif module_info_from_discovery['device_type'] == 'shelly':
-            shelly_relays = set()
-            for t in module_info_from_discovery['topics']:
-                parsed_type, parsed_serial, comp_type, comp_id, _ = parse_mqtt_device_topic(t)
-                if parsed_serial == discovered_module_serial_for_slot and comp_type == 'relay' and comp_id:
-                    shelly_relays.add(comp_id)
-            num_switches = len(shelly_relays) if shelly_relays else 1
+            num_switches = sum(1 for comp_type, _ in discovered_topic_index if comp_type == 'relay') or 1
         config.set(relay_module_section, 'numberofswitches', str(num_switches))
     else:
         while True:
             try:
-                num_switches_input = input(f"Enter the number of switches for Relay Module {module_idx} (current: {current_num_switches_for_module if current_num_switches_for_module > 0 else 'not set'}): ")
+                num_switches_input = _ask(f"Enter the number of switches for Relay Module {module_idx} (current: {current_num_switches_for_module if current_num_switches_for_module > 0 else 'not set'}): ")
                 if num_switches_input:
                     num_switches = int(num_switches_input)
                     if num_switches <= 0:
@@ -286,6 +520,8 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
                 elif current_num_switches_for_module > 0:
                     num_switches = current_num_switches_for_module
                     break
+                elif NONINTERACTIVE:
+                    sys.exit(f"Relay Module {module_idx} has no number of switches set, so it can't be configured non-interactively.")
                 else:
                     print("Invalid input. Please enter a positive integer for the number of switches.")
             except ValueError:
@@ -296,12 +532,7 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
     current_num_inputs_for_module = module_data_from_file.get('numberofinputs', 0)
     if is_auto_configured_for_this_slot and module_info_from_discovery:
         if module_info_from_discovery['device_type'] == 'dingtian':
-            dingtian_in_inputs = set()
-            for t in module_info_from_discovery['topics']:
-                parsed_type, parsed_serial, comp_type, comp_id, _ = parse_mqtt_device_topic(t)
-                if parsed_serial == discovered_module_serial_for_slot and comp_type == 'in' and comp_id:
-                    dingtian_in_inputs.add(comp_id)
-            num_inputs = len(dingtian_in_inputs)
+            num_inputs = sum(1 for comp_type, _ in discovered_topic_index if comp_type == 'in')
             config.set(relay_module_section, 'numberofinputs', str(num_inputs))
         elif module_info_from_discovery['device_type'] == 'shelly':
             num_inputs = 0
@@ -309,7 +540,7 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
     else:
         while True:
             try:
-                num_inputs_input = input(f"Enter the number of inputs for Relay Module {module_idx} (current: {current_num_inputs_for_module}): ")
+                num_inputs_input = _ask(f"Enter the number of inputs for Relay Module {module_idx} (current: {current_num_inputs_for_module}): ")
                 if num_inputs_input:
                     num_inputs = int(num_inputs_input)
                     if num_inputs < 0:
@@ -337,30 +568,20 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
         config.set(relay_module_section, 'mqtt_on_command_payload', default_payloads['on_cmd'])
         config.set(relay_module_section, 'mqtt_off_command_payload', default_payloads['off_cmd'])
     else:
-        current_mqtt_on_state_payload = module_data_from_file.get('mqtt_on_state_payload', default_payloads['on_state'])
-        mqtt_on_state_payload = input(f"Enter MQTT ON state payload for Relay Module {module_idx} (current: {current_mqtt_on_state_payload}): ")
-        config.set(relay_module_section, 'mqtt_on_state_payload', mqtt_on_state_payload if mqtt_on_state_payload else current_mqtt_on_state_payload)
-
-        current_mqtt_off_state_payload = module_data_from_file.get('mqtt_off_state_payload', default_payloads['off_state'])
-        mqtt_off_state_payload = input(f"Enter MQTT OFF state payload for Relay Module {module_idx} (current: {current_mqtt_off_state_payload}): ")
-        config.set(relay_module_section, 'mqtt_off_state_payload', mqtt_off_state_payload if mqtt_off_state_payload else current_mqtt_off_state_payload)
+        # Manual entry always starts from the Dingtian payload defaults
+        prompt_and_set(config, relay_module_section, module_data_from_file, RELAY_MODULE_PAYLOAD_FIELDS, module_idx)
 
-        current_mqtt_on_command_payload = module_data_from_file.get('mqtt_on_command_payload', default_payloads['on_cmd'])
-        mqtt_on_command_payload = input(f"Enter MQTT ON command payload for Relay Module {module_idx} (current: {current_mqtt_on_command_payload}): ")
-        config.set(relay_module_section, 'mqtt_on_command_payload', mqtt_on_command_payload if mqtt_on_command_payload else current_mqtt_on_command_payload)
-
-        current_mqtt_off_command_payload = module_data_from_file.get('mqtt_off_command_payload', default_payloads['off_cmd'])
-        mqtt_off_command_payload = input(f"Enter MQTT OFF command payload for Relay Module {module_idx} (current: {current_mqtt_off_command_payload}): ")
-        config.set(relay_module_section, 'mqtt_off_command_payload', mqtt_off_command_payload if mqtt_off_command_payload else current_mqtt_off_command_payload)
+    # Switch and input fields are staged per section and applied with one read_dict() below
+    staged_sections = {}
 
     # Configure switches for this module
     num_switches_for_module_section = int(config.get(relay_module_section, 'numberofswitches'))
     for j in range(1, num_switches_for_module_section + 1):
         switch_section = f'switch_{module_idx}_{j}'
+        switch_label = f'switch {j}' # Shared by this switch's prompts and its default name
         switch_data_from_file = existing_switches_by_module_and_switch_idx.get((module_idx, j), {})
 
-        if not config.has_section(switch_section):
-            config.add_section(switch_section)
+        switch_values = staged_sections[switch_section] = {}
 
         auto_discovered_state_topic = None
         auto_discovered_command_topic = None
@@ -370,37 +591,34 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
             device_type = module_info_from_discovery['device_type']
 
             if device_type == 'dingtian':
-                for t in module_info_from_discovery['topics']:
-                    parsed_type, parsed_serial, parsed_comp_type, parsed_comp_id, _ = parse_mqtt_device_topic(t)
-                    if parsed_serial == discovered_module_serial_for_slot and parsed_comp_type == 'out' and parsed_comp_id == str(j):
-                        auto_discovered_state_topic = t
-                        auto_discovered_command_topic = t.replace('/out/r', '/in/r', 1)
-                        break
+                auto_discovered_state_topic = discovered_topic_index.get(('out', str(j)))
+                if auto_discovered_state_topic:
+                    # The indexed state topic is known to end in '/out/r<j>', so swap that suffix for '/in/r<j>'
+                    state_suffix = f'/out/r{j}'
+                    auto_discovered_command_topic = f'{auto_discovered_state_topic[:-len(state_suffix)]}/in/r{j}'
             elif device_type == 'shelly':
                 shelly_switch_idx = j - 1
                 auto_discovered_state_topic = f'{base_topic_path}/status/switch:{shelly_switch_idx}'
                 auto_discovered_command_topic = f'{base_topic_path}/command/switch:{shelly_switch_idx}'
 
-        current_switch_custom_name = switch_data_from_file.get('customname', f'switch {j}')
-        config.set(switch_section, 'customname', input(f"Enter custom name for switch {j} (current: {current_switch_custom_name}): ") or current_switch_custom_name)
+        current_switch_custom_name = switch_data_from_file.get('customname', switch_label)
+        switch_values['customname'] = prompt_value(f"Enter custom name for {switch_label}", current_switch_custom_name)
 
         current_switch_group = switch_data_from_file.get('group', f'Group{module_idx}')
-        config.set(switch_section, 'group', input(f"Enter group for switch {j} (current: {current_switch_group}): ") or current_switch_group)
+        switch_values['group'] = prompt_value(f"Enter group for {switch_label}", current_switch_group)
 
 
         current_mqtt_state_topic = switch_data_from_file.get('mqttstatetopic', auto_discovered_state_topic if auto_discovered_state_topic else 'path/to/mqtt/topic')
         if is_auto_configured_for_this_slot:
-            config.set(switch_section, 'mqttstatetopic', current_mqtt_state_topic)
+            switch_values['mqttstatetopic'] = current_mqtt_state_topic
         else:
-            mqtt_state_topic = input(f"Enter MQTT state topic for switch {j} (current: {current_mqtt_state_topic}): ")
-            config.set(switch_section, 'mqttstatetopic', mqtt_state_topic if mqtt_state_topic else current_mqtt_state_topic)
+            switch_values['mqttstatetopic'] = prompt_value(f"Enter MQTT state topic for {switch_label}", current_mqtt_state_topic)
 
         current_mqtt_command_topic = switch_data_from_file.get('mqttcommandtopic', auto_discovered_command_topic if auto_discovered_command_topic else 'path/to/mqtt/topic')
         if is_auto_configured_for_this_slot:
-            config.set(switch_section, 'mqttcommandtopic', current_mqtt_command_topic)
+            switch_values['mqttcommandtopic'] = current_mqtt_command_topic
         else:
-            mqtt_command_topic = input(f"Enter MQTT command topic for switch {j} (current: {current_mqtt_command_topic}): ")
-            config.set(switch_section, 'mqttcommandtopic', mqtt_command_topic if mqtt_command_topic else current_mqtt_command_topic)
+            switch_values['mqttcommandtopic'] = prompt_value(f"Enter MQTT command topic for {switch_label}", current_mqtt_command_topic)
 
     # Clean up excess switches if number of switches was reduced
     for j in range(num_switches_for_module_section + 1, 100): # Assuming max 99 switches
@@ -414,84 +632,75 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
     num_inputs_for_module_section = int(config.get(relay_module_section, 'numberofinputs'))
     for k in range(1, num_inputs_for_module_section + 1):
         input_section = f'input_{module_idx}_{k}'
+        input_label = f'Input {k}' # Shared by this input's prompts and its default name
         input_data_from_file = existing_inputs_by_module_and_input_idx.get((module_idx, k), {})
 
-        if not config.has_section(input_section):
-            config.add_section(input_section)
+        input_values = staged_sections[input_section] = {}
 
         current_input_serial = input_data_from_file.get('serial', None)
         if current_input_serial is None:
             current_input_serial = f"input-{module_idx}-{k}"
             logger.debug(f"Generated new serial {current_input_serial} for Relay Module {module_idx}, Input {k}.")
-        config.set(input_section, 'serial', current_input_serial)
+        input_values['serial'] = current_input_serial
 
         # Device instance and index for inputs
         if is_new_device_flow:
-            config.set(input_section, 'deviceinstance', str(device_instance_counter))
+            input_values['deviceinstance'] = str(device_instance_counter)
             device_instance_counter += 1
         else:
             current_device_instance = input_data_from_file.get('deviceinstance', highest_existing_device_instance + 1)
-            config.set(input_section, 'deviceinstance', str(current_device_instance))
+            input_values['deviceinstance'] = str(current_device_instance)
 
         if is_new_device_flow:
-            config.set(input_section, 'deviceindex', str(device_index_sequencer))
+            input_values['deviceindex'] = str(device_index_sequencer)
             device_index_sequencer += 1
         else:
             current_device_index = input_data_from_file.get('deviceindex', highest_existing_device_index + 1)
-            config.set(input_section, 'deviceindex', str(current_device_index))
+            input_values['deviceindex'] = str(current_device_index)
 
 
-        current_input_custom_name = input_data_from_file.get('customname', f'Input {k}')
+        current_input_custom_name = input_data_from_file.get('customname', input_label)
         if is_auto_configured_for_this_slot and module_info_from_discovery and module_info_from_discovery['device_type'] == 'dingtian':
-            config.set(input_section, 'customname', current_input_serial)
+            input_values['customname'] = current_input_serial
         else:
-            config.set(input_section, 'customname', input(f"Enter custom name for Input {k} (current: {current_input_custom_name}): ") or current_input_custom_name)
+            input_values['customname'] = prompt_value(f"Enter custom name for {input_label}", current_input_custom_name)
 
         auto_discovered_input_state_topic = None
         if is_auto_configured_for_this_slot and module_info_from_discovery and module_info_from_discovery['device_type'] == 'dingtian':
-            base_topic_path = module_info_from_discovery['base_topic_path']
-            for t in module_info_from_discovery['topics']:
-                parsed_type, parsed_serial, parsed_comp_type, parsed_comp_id, _ = parse_mqtt_device_topic(t)
-                if parsed_serial == discovered_module_serial_for_slot and parsed_comp_type == 'in' and parsed_comp_id == str(k):
-                    auto_discovered_input_state_topic = t
-                    break
+            auto_discovered_input_state_topic = discovered_topic_index.get(('in', str(k)))
 
         current_mqtt_input_state_topic = input_data_from_file.get('mqttstatetopic', auto_discovered_input_state_topic if auto_discovered_input_state_topic else 'path/to/mqtt/input/topic')
         if is_auto_configured_for_this_slot and module_info_from_discovery and module_info_from_discovery['device_type'] == 'dingtian':
-            config.set(input_section, 'mqttstatetopic', current_mqtt_input_state_topic)
+            input_values['mqttstatetopic'] = current_mqtt_input_state_topic
         else:
-            mqtt_input_state_topic = input(f"Enter MQTT state topic for Input {k} (current: {current_mqtt_input_state_topic}): ")
-            config.set(input_section, 'mqttstatetopic', mqtt_input_state_topic if mqtt_input_state_topic else current_mqtt_input_state_topic)
+            input_values['mqttstatetopic'] = prompt_value(f"Enter MQTT state topic for {input_label}", current_mqtt_input_state_topic)
 
         current_mqtt_input_on_state_payload = input_data_from_file.get('mqtt_on_state_payload', 'ON')
         if is_auto_configured_for_this_slot and module_info_from_discovery and module_info_from_discovery['device_type'] == 'dingtian':
-            config.set(input_section, 'mqtt_on_state_payload', 'ON')
+            input_values['mqtt_on_state_payload'] = 'ON'
         else:
-            mqtt_input_on_state_payload = input(f"Enter MQTT ON state payload for Input {k} (current: {current_mqtt_input_on_state_payload}): ")
-            config.set(input_section, 'mqtt_on_state_payload', mqtt_input_on_state_payload if mqtt_input_on_state_payload else current_mqtt_input_on_state_payload)
+            input_values['mqtt_on_state_payload'] = prompt_value(f"Enter MQTT ON state payload for {input_label}", current_mqtt_input_on_state_payload)
 
         current_mqtt_input_off_state_payload = input_data_from_file.get('mqtt_off_state_payload', 'OFF')
         if is_auto_configured_for_this_slot and module_info_from_discovery and module_info_from_discovery['device_type'] == 'dingtian':
-            config.set(input_section, 'mqtt_off_state_payload', 'OFF')
+            input_values['mqtt_off_state_payload'] = 'OFF'
         else:
-            mqtt_input_off_state_payload = input(f"Enter MQTT OFF state payload for Input {k} (current: {current_mqtt_input_off_state_payload}): ")
-            config.set(input_section, 'mqtt_off_state_payload', mqtt_input_off_state_payload if mqtt_input_off_state_payload else current_mqtt_input_off_state_payload)
+            input_values['mqtt_off_state_payload'] = prompt_value(f"Enter MQTT OFF state payload for {input_label}", current_mqtt_input_off_state_payload)
 
-        input_types = ['disabled', 'door alarm', 'bilge pump', 'bilge alarm', 'burglar alarm', 'smoke alarm', 'fire alarm', 'CO2 alarm']
         current_input_type = input_data_from_file.get('type', 'disabled')
         if is_auto_configured_for_this_slot and module_info_from_discovery and module_info_from_discovery['device_type'] == 'dingtian':
-            config.set(input_section, 'type', 'disabled')
+            input_values['type'] = 'disabled'
         else:
             while True:
-                input_type_input = input(f"Enter type for Input {k} (options: {', '.join(input_types)}; current: {current_input_type}): ")
+                input_type_input = _ask(f"Enter type for {input_label} (options: {INPUT_TYPES_DISPLAY}; current: {current_input_type}): ")
                 if input_type_input:
-                    if input_type_input.lower() in input_types:
-                        config.set(input_section, 'type', input_type_input.lower())
+                    if input_type_input.lower() in INPUT_TYPES_SET:
+                        input_values['type'] = input_type_input.lower()
                         break
                     else:
-                        print(f"Invalid type. Please choose from: {', '.join(input_types)}")
+                        print(f"Invalid type. Please choose from: {INPUT_TYPES_DISPLAY}")
                 else:
-                    config.set(input_section, 'type', current_input_type)
+                    input_values['type'] = current_input_type
                     break
     # Clean up excess inputs if number of inputs was reduced
     for k in range(num_inputs_for_module_section + 1, 100): # Assuming max 99 inputs
@@ -500,6 +709,8 @@ def configure_relay_module(config, existing_relay_modules_by_index, existing_swi
             config.remove_section(input_section)
             print(f"Removed excess input section: {input_section}")
 
+    config.read_dict(staged_sections)
+
     # Update Global numberofmodules if adding a new one
     if is_new_device_flow:
         current_global_modules = config.getint('Global', 'numberofmodules', fallback=0)
@@ -544,39 +755,24 @@ def configure_temp_sensor(config, existing_temp_sensors_by_index, device_instanc
 
 
     current_custom_name = sensor_data_from_file.get('customname', f'Temperature Sensor {sensor_idx}')
-    custom_name = input(f"Enter custom name for Temperature Sensor {sensor_idx} (current: {current_custom_name}): ")
-    config.set(temp_sensor_section, 'customname', custom_name if custom_name else current_custom_name)
+    config.set(temp_sensor_section, 'customname', prompt_value(f"Enter custom name for Temperature Sensor {sensor_idx}", current_custom_name))
 
-    current_serial = sensor_data_from_file.get('serial', generate_serial())
-    if not sensor_data_from_file.get('serial'):
-        print(f"Generated new serial for Temperature Sensor {sensor_idx}: {current_serial}")
-    config.set(temp_sensor_section, 'serial', current_serial)
+    ensure_serial(config, temp_sensor_section, sensor_data_from_file, f'Temperature Sensor {sensor_idx}')
 
-    temp_sensor_types = ['battery', 'fridge', 'room', 'outdoor', 'water heater', 'freezer', 'generic']
     current_temp_sensor_type = sensor_data_from_file.get('type', 'generic')
     while True:
-        temp_type_input = input(f"Enter type for Temperature Sensor {sensor_idx} (options: {', '.join(temp_sensor_types)}; current: {current_temp_sensor_type}): ")
+        temp_type_input = _ask(f"Enter type for Temperature Sensor {sensor_idx} (options: {TEMP_SENSOR_TYPES_DISPLAY}; current: {current_temp_sensor_type}): ")
         if temp_type_input:
-            if temp_type_input.lower() in temp_sensor_types:
+            if temp_type_input.lower() in TEMP_SENSOR_TYPES_SET:
                 config.set(temp_sensor_section, 'type', temp_type_input.lower())
                 break
             else:
-                print(f"Invalid type. Please choose from: {', '.join(temp_sensor_types)}")
+                print(f"Invalid type. Please choose from: {TEMP_SENSOR_TYPES_DISPLAY}")
         else:
             config.set(temp_sensor_section, 'type', current_temp_sensor_type)
             break
 
-    current_temp_state_topic = sensor_data_from_file.get('temperaturestatetopic', 'path/to/mqtt/topic')
-    temp_state_topic = input(f"Enter MQTT temperature state topic for Temperature Sensor {sensor_idx} (current: {current_temp_state_topic}): ")
-    config.set(temp_sensor_section, 'temperaturestatetopic', temp_state_topic if temp_state_topic else current_temp_state_topic)
-
-    current_humidity_state_topic = sensor_data_from_file.get('humiditystatetopic', 'path/to/mqtt/topic')
-    humidity_state_topic = input(f"Enter MQTT humidity state topic for Temperature Sensor {sensor_idx} (current: {current_humidity_state_topic}): ")
-    config.set(temp_sensor_section, 'humiditystatetopic', humidity_state_topic if humidity_state_topic else current_humidity_state_topic)
-
-    current_battery_state_topic = sensor_data_from_file.get('batterystatetopic', 'path/to/mqtt/topic')
-    battery_state_topic = input(f"Enter MQTT battery state topic for Temperature Sensor {sensor_idx} (current: {current_battery_state_topic}): ")
-    config.set(temp_sensor_section, 'batterystatetopic', battery_state_topic if battery_state_topic else current_battery_state_topic)
+    prompt_and_set(config, temp_sensor_section, sensor_data_from_file, TEMP_SENSOR_TOPIC_FIELDS, sensor_idx)
 
     if is_new_device_flow:
         current_global_temp_sensors = config.getint('Global', 'numberoftempsensors', fallback=0)
@@ -589,12 +785,6 @@ def configure_tank_sensor(config, existing_tank_sensors_by_index, device_instanc
                           highest_existing_device_instance=99, highest_existing_device_index=0):
     """Configures a single tank sensor."""
 
-    fluid_types_map = {
-        'fuel': 0, 'fresh water': 1, 'waste water': 2, 'live well': 3,
-        'oil': 4, 'black water': 5, 'gasoline': 6, 'diesel': 7,
-        'lpg': 8, 'lng': 9, 'hydraulic oil': 10, 'raw water': 11
-    }
-
     if is_new_device_flow:
         if existing_tank_sensors_by_index:
             sensor_idx = max(existing_tank_sensors_by_index.keys()) + 1
@@ -627,36 +817,17 @@ def configure_tank_sensor(config, existing_tank_sensors_by_index, device_instanc
 
 
     current_custom_name = sensor_data_from_file.get('customname', f'Tank Sensor {sensor_idx}')
-    custom_name = input(f"Enter custom name for Tank Sensor {sensor_idx} (current: {current_custom_name}): ")
-    config.set(tank_sensor_section, 'customname', custom_name if custom_name else current_custom_name)
-
-    current_serial = sensor_data_from_file.get('serial', generate_serial())
-    if not sensor_data_from_file.get('serial'):
-        print(f"Generated new serial for Tank Sensor {sensor_idx}: {current_serial}")
-    config.set(tank_sensor_section, 'serial', current_serial)
+    config.set(tank_sensor_section, 'customname', prompt_value(f"Enter custom name for Tank Sensor {sensor_idx}", current_custom_name))
 
-    current_level_state_topic = sensor_data_from_file.get('levelstatetopic', 'path/to/mqtt/topic')
-    level_state_topic = input(f"Enter MQTT level state topic for Tank Sensor {sensor_idx} (current: {current_level_state_topic}): ")
-    config.set(tank_sensor_section, 'levelstatetopic', level_state_topic if level_state_topic else current_level_state_topic)
+    ensure_serial(config, tank_sensor_section, sensor_data_from_file, f'Tank Sensor {sensor_idx}')
 
-    current_battery_state_topic = sensor_data_from_file.get('batterystatetopic', 'path/to/mqtt/topic')
-    battery_state_topic = input(f"Enter MQTT battery state topic for Tank Sensor {sensor_idx} (current: {current_battery_state_topic}): ")
-    config.set(tank_sensor_section, 'batterystatetopic', battery_state_topic if battery_state_topic else current_battery_state_topic)
+    prompt_and_set(config, tank_sensor_section, sensor_data_from_file, TANK_SENSOR_TOPIC_FIELDS, sensor_idx)
 
-    current_temp_state_topic = sensor_data_from_file.get('temperaturestatetopic', 'path/to/mqtt/topic')
-    temp_state_topic = input(f"Enter MQTT temperature state topic for Tank Sensor {sensor_idx} (current: {current_temp_state_topic}): ")
-    config.set(tank_sensor_section, 'temperaturestatetopic', temp_state_topic if temp_state_topic else current_temp_state_topic)
-
-    current_raw_value_state_topic = sensor_data_from_file.get('rawvaluestatetopic', 'path/to/mqtt/topic')
-    raw_value_state_topic = input(f"Enter MQTT raw value state topic for Tank Sensor {sensor_idx} (current: {current_raw_value_state_topic}): ")
-    config.set(tank_sensor_section, 'rawvaluestatetopic', raw_value_state_topic if raw_value_state_topic else current_raw_value_state_topic)
-
-    fluid_types_display = ", ".join([f"'{name}'" for name in fluid_types_map.keys()])
     current_fluid_type_name = sensor_data_from_file.get('fluidtype', 'fresh water')
     while True:
-        fluid_type_input = input(f"Enter fluid type for Tank Sensor {sensor_idx} (options: {fluid_types_display}; current: '{current_fluid_type_name}'): ")
+        fluid_type_input = _ask(f"Enter fluid type for Tank Sensor {sensor_idx} (options: {FLUID_TYPES_DISPLAY}; current: '{current_fluid_type_name}'): ")
         if fluid_type_input:
-            if fluid_type_input.lower() in fluid_types_map:
+            if fluid_type_input.lower() in FLUID_TYPES:
                 config.set(tank_sensor_section, 'fluidtype', fluid_type_input.lower())
                 break
             else:
@@ -665,14 +836,7 @@ def configure_tank_sensor(config, existing_tank_sensors_by_index, device_instanc
             config.set(tank_sensor_section, 'fluidtype', current_fluid_type_name)
             break
 
-    current_raw_value_empty = sensor_data_from_file.get('rawvalueempty', '0')
-    config.set(tank_sensor_section, 'rawvalueempty', input(f"Enter raw value for empty tank (current: {current_raw_value_empty}): ") or current_raw_value_empty)
-
-    current_raw_value_full = sensor_data_from_file.get('rawvaluefull', '240')
-    config.set(tank_sensor_section, 'rawvaluefull', input(f"Enter raw value for full tank (current: {current_raw_value_full}): ") or current_raw_value_full)
-
-    current_capacity = sensor_data_from_file.get('capacity', '0.2')
-    config.set(tank_sensor_section, 'capacity', input(f"Enter tank capacity in m³ (current: {current_capacity}): ") or current_capacity)
+    prompt_and_set(config, tank_sensor_section, sensor_data_from_file, TANK_SENSOR_CALIBRATION_FIELDS, sensor_idx)
 
     if is_new_device_flow:
         current_global_tank_sensors = config.getint('Global', 'numberoftanksensors', fallback=0)
@@ -717,53 +881,11 @@ def configure_virtual_battery(config, existing_virtual_batteries_by_index, devic
 
 
     current_custom_name = battery_data_from_file.get('customname', f'Virtual Battery {battery_idx}')
-    custom_name = input(f"Enter custom name for Virtual Battery {battery_idx} (current: {current_custom_name}): ")
-    config.set(virtual_battery_section, 'customname', custom_name if custom_name else current_custom_name)
-
-    current_serial = battery_data_from_file.get('serial', generate_serial())
-    if not battery_data_from_file.get('serial'):
-        print(f"Generated new serial for Virtual Battery {battery_idx}: {current_serial}")
-    config.set(virtual_battery_section, 'serial', current_serial)
-
-    current_capacity = battery_data_from_file.get('capacityah', '100')
-    capacity = input(f"Enter capacity for Virtual Battery {battery_idx} in Ah (current: {current_capacity}): ")
-    config.set(virtual_battery_section, 'capacityah', capacity if capacity else current_capacity)
-
-    current_current_state_topic = battery_data_from_file.get('currentstatetopic', 'path/to/mqtt/topic')
-    current_state_topic = input(f"Enter MQTT battery current state topic for Virtual Battery {battery_idx} (current: {current_current_state_topic}): ")
-    config.set(virtual_battery_section, 'currentstatetopic', current_state_topic if current_state_topic else current_current_state_topic)
-
-    current_power_state_topic = battery_data_from_file.get('powerstatetopic', 'path/to/mqtt/topic')
-    power_state_topic = input(f"Enter MQTT battery power state topic for Virtual Battery {battery_idx} (current: {current_power_state_topic}): ")
-    config.set(virtual_battery_section, 'powerstatetopic', power_state_topic if power_state_topic else current_power_state_topic)
-
-    current_temperature_state_topic = battery_data_from_file.get('temperaturestatetopic', 'path/to/mqtt/topic')
-    temperature_state_topic = input(f"Enter MQTT temperature state topic for Virtual Battery {battery_idx} (current: {current_temperature_state_topic}): ")
-    config.set(virtual_battery_section, 'temperaturestatetopic', temperature_state_topic if temperature_state_topic else current_temperature_state_topic)
-
-    current_voltage_state_topic = battery_data_from_file.get('voltagestatetopic', 'path/to/mqtt/topic')
-    voltage_state_topic = input(f"Enter MQTT voltage state topic for Virtual Battery {battery_idx} (current: {current_voltage_state_topic}): ")
-    config.set(virtual_battery_section, 'voltagestatetopic', voltage_state_topic if voltage_state_topic else current_voltage_state_topic)
-
-    current_max_charge_current_state_topic = battery_data_from_file.get('maxchargecurrentstatetopic', 'path/to/mqtt/topic')
-    max_charge_current_state_topic = input(f"Enter MQTT max charge current state topic for Virtual Battery {battery_idx} (current: {current_max_charge_current_state_topic}): ")
-    config.set(virtual_battery_section, 'maxchargecurrentstatetopic', max_charge_current_state_topic if max_charge_current_state_topic else current_max_charge_current_state_topic)
-
-    current_max_charge_voltage_state_topic = battery_data_from_file.get('maxchargevoltagestatetopic', 'path/to/mqtt/topic')
-    max_charge_voltage_state_topic = input(f"Enter MQTT max charge voltage state topic for Virtual Battery {battery_idx} (current: {current_max_charge_voltage_state_topic}): ")
-    config.set(virtual_battery_section, 'maxchargevoltagestatetopic', max_charge_voltage_state_topic if max_charge_voltage_state_topic else current_max_charge_voltage_state_topic)
-
-    current_max_discharge_current_state_topic = battery_data_from_file.get('maxdischargecurrentstatetopic', 'path/to/mqtt/topic')
-    max_discharge_current_state_topic = input(f"Enter MQTT max discharge current state topic for Virtual Battery {battery_idx} (current: {current_max_discharge_current_state_topic}): ")
-    config.set(virtual_battery_section, 'maxdischargecurrentstatetopic', max_discharge_current_state_topic if max_discharge_current_state_topic else current_max_discharge_current_state_topic)
+    config.set(virtual_battery_section, 'customname', prompt_value(f"Enter custom name for Virtual Battery {battery_idx}", current_custom_name))
 
-    current_soc_state_topic = battery_data_from_file.get('socstatetopic', 'path/to/mqtt/topic')
-    soc_state_topic = input(f"Enter MQTT SOC state topic for Virtual Battery {battery_idx} (current: {current_soc_state_topic}): ")
-    config.set(virtual_battery_section, 'socstatetopic', soc_state_topic if soc_state_topic else current_soc_state_topic)
+    ensure_serial(config, virtual_battery_section, battery_data_from_file, f'Virtual Battery {battery_idx}')
 
-    current_soh_state_topic = battery_data_from_file.get('sohstatetopic', 'path/to/mqtt/topic')
-    soh_state_topic = input(f"Enter MQTT SOH state topic for Virtual Battery {battery_idx} (current: {current_soh_state_topic}): ")
-    config.set(virtual_battery_section, 'sohstatetopic', soh_state_topic if soh_state_topic else current_soh_state_topic)
+    prompt_and_set(config, virtual_battery_section, battery_data_from_file, VIRTUAL_BATTERY_FIELDS, battery_idx)
 
     if is_new_device_flow:
         current_global_virtual_batteries = config.getint('Global', 'numberofvirtualbatteries', fallback=0)
@@ -778,7 +900,7 @@ def configure_global_settings(config, existing_loglevel, existing_mqtt_broker, e
     if not config.has_section('Global'):
         config.add_section('Global')
 
-    loglevel = input(f"Set logging level to INFO or DEBUG, (current: {existing_loglevel if existing_loglevel else 'INFO'}): ") or (existing_loglevel if existing_loglevel else 'INFO')
+    loglevel = _ask(f"Set logging level to INFO or DEBUG, (current: {existing_loglevel if existing_loglevel else 'INFO'}): ") or (existing_loglevel if existing_loglevel else 'INFO')
     config.set('Global', 'loglevel', loglevel)
 
     # update existing log level after config change
@@ -791,12 +913,13 @@ def configure_global_settings(config, existing_loglevel, existing_mqtt_broker, e
         current_username=existing_mqtt_username,
         current_password=existing_mqtt_password
     )
-    if not config.has_section('MQTT'):
-        config.add_section('MQTT')
-    config.set('MQTT', 'brokeraddress', broker_address)
-    config.set('MQTT', 'port', str(port))
-    config.set('MQTT', 'username', username if username is not None else '')
-    config.set('MQTT', 'password', password if password is not None else '')
+    # One bulk update, which also creates the section; any other MQTT keys are kept
+    config.read_dict({'MQTT': {
+        'brokeraddress': broker_address,
+        'port': str(port),
+        'username': username or '',
+        'password': password or '',
+    }})
 
 
 
@@ -840,33 +963,13 @@ def configure_pv_charger(config, existing_pv_chargers_by_index, device_instance_
 
     # Custom name
     current_custom_name = charger_data.get('customname', f'PV Charger {charger_idx}')
-    custom_name = input(f"Enter custom name for PV Charger {charger_idx} (current: {current_custom_name}): ")
-    config.set(pv_charger_section, 'customname', custom_name or current_custom_name)
+    config.set(pv_charger_section, 'customname', prompt_value(f"Enter custom name for PV Charger {charger_idx}", current_custom_name))
 
     # Serial number (generated if not already assigned)
-    serial = charger_data.get('serial', generate_serial())
-    if not charger_data.get('serial'):
-        print(f"Generated new serial for PV Charger {charger_idx}: {serial}")
-    config.set(pv_charger_section, 'serial', serial)
+    ensure_serial(config, pv_charger_section, charger_data, f'PV Charger {charger_idx}')
 
     # Required MQTT state topics
-    topic_keys = [
-        ('batterycurrentstatetopic', 'battery current'),
-        ('batteryvoltagestatetopic', 'battery voltage'),
-        ('maxchargecurrentstatetopic', 'max charge current'),
-        ('maxchargevoltagestatetopic', 'max charge voltage'),
-        ('pvvoltagestatetopic', 'PV voltage'),
-        ('pvpowerstatetopic', 'PV power'),
-        ('chargerstatetopic', 'charger state'),
-        ('loadstatetopic', 'load state'),
-        ('totalyield', 'total user accumulated yield'),
-        ('systemyield', 'total system accumulated yield')
-    ]
-
-    for key, label in topic_keys:
-        current_topic = charger_data.get(key, f'path/to/mqtt/topic')
-        topic = input(f"Enter MQTT topic for {label} (current: {current_topic}): ")
-        config.set(pv_charger_section, key, topic or current_topic)
+    prompt_and_set(config, pv_charger_section, charger_data, PV_CHARGER_TOPIC_FIELDS, charger_idx)
 
     # Update Global count
     if is_new_device_flow:
@@ -876,6 +979,112 @@ def configure_pv_charger(config, existing_pv_chargers_by_index, device_instance_
     return device_instance_counter, device_index_sequencer
 
 
+def run_relay_module_discovery(config, existing_relay_modules_by_index, auto_configured_serials_to_info):
+    """
+    Offers MQTT discovery before adding a relay module and stages the modules the user selects
+    in auto_configured_serials_to_info. Returns False if discovery can't run because no broker is set.
+    """
+    discovery_choice = _ask("\nDo you want to try to discover Dingtian/Shelly modules via MQTT for auto-configuration?(yes/no): ").lower()
+    if discovery_choice != 'yes':
+        print("\nSkipping MQTT discovery for auto-configuration.")
+        return True
+
+    # Ensure we use the latest broker info from config
+    broker_address = config.get('MQTT', 'brokeraddress', fallback='localhost')
+    port = config.getint('MQTT', 'port', fallback=1883)
+    username = config.get('MQTT', 'username', fallback='')
+    password = config.get('MQTT', 'password', fallback='')
+
+    if not broker_address:
+        logger.error("\nMQTT Broker address is not set. Cannot perform discovery.")
+        print("Please configure MQTT details in 'Global Settings' first.")
+        return False
+
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    if username:
+        mqtt_client.username_pw_set(username, password)
+    try:
+        print(f"Connecting to MQTT broker at {broker_address}:{port}...")
+        mqtt_client.connect(broker_address, port, 60)
+        print("Connected to MQTT broker.")
+        all_discovered_modules_with_topics = discover_devices_via_mqtt(mqtt_client)
+        mqtt_client.disconnect()
+        print("Disconnected from MQTT broker.")
+
+        newly_discovered_modules_to_propose = {}
+        skipped_modules_count = 0
+        # Serials and moduleserials already in the config, collected once for O(1) membership checks
+        existing_relay_module_serials = set()
+        for existing_mod_data in existing_relay_modules_by_index.values():
+            existing_relay_module_serials.add(existing_mod_data.get('serial'))
+            existing_relay_module_serials.add(existing_mod_data.get('moduleserial'))
+        for module_serial, module_info in all_discovered_modules_with_topics.items():
+            if module_serial not in existing_relay_module_serials:
+                newly_discovered_modules_to_propose[module_serial] = module_info
+            else:
+                skipped_modules_count += 1
+        if skipped_modules_count > 0:
+            print(f"\nSkipped {skipped_modules_count} discovered modules as they appear to be already configured by serial or moduleserial.")
+
+        if not newly_discovered_modules_to_propose:
+            print("\nNo new Dingtian or Shelly modules found via MQTT topic discovery to auto-configure.")
+            return True
+
+        print("\n--- Newly Discovered Modules (by Serial Number) ---")
+        discovered_module_serials_list = sorted(newly_discovered_modules_to_propose)
+        for i, module_serial in enumerate(discovered_module_serials_list):
+            module_info = newly_discovered_modules_to_propose[module_serial]
+            print(f"{i+1}) Device Type: {module_info['device_type'].capitalize()}, Module Serial: {module_serial}")
+
+        selected_indices_input = _ask("Enter the number of the module you want to auto-configure (e.g., 1,3 or 'all'; enter to skip): ")
+        selected_serials_for_auto_config = []
+
+        if selected_indices_input.lower() == 'all':
+            selected_serials_for_auto_config = discovered_module_serials_list
+        else:
+            try:
+                if selected_indices_input:
+                    indices = [int(x.strip()) - 1 for x in selected_indices_input.split(',')]
+                    for idx in indices:
+                        if 0 <= idx < len(discovered_module_serials_list):
+                            selected_serials_for_auto_config.append(discovered_module_serials_list[idx])
+                        else:
+                            print(f"Warning: Invalid selection number {idx+1} ignored.")
+            except ValueError:
+                print("Invalid input for selection. No specific modules selected for auto-configuration.")
+
+        if selected_serials_for_auto_config:
+            print(f"\n--- Staging Auto-Configuration for Selected Modules ---")
+            for module_serial in selected_serials_for_auto_config:
+                auto_configured_serials_to_info[module_serial] = newly_discovered_modules_to_propose[module_serial]
+                print(f"  Module {module_serial} selected for auto-configuration.")
+        else:
+            print("\nNo specific modules selected for auto-configuration.")
+    except Exception as e:
+        logger.error(f"\nCould not connect to MQTT broker or perform discovery: {e}")
+        print("Proceeding without MQTT discovery for auto-configuration.")
+    return True
+
+
+# Menus redrawn on every pass of the configuration loops, printed with one call each
+MAIN_MENU_TEXT = (
+    "\n--- Main Configuration Menu ---\n"
+    "1) Global Settings\n"
+    "2) Add New Device\n"
+    "3) Edit Existing Device\n"
+    "4) Remove Existing Device\n"
+    "5) Exit"
+)
+ADD_DEVICE_MENU_TEXT = (
+    "\n--- Add New Device ---\n"
+    "1) Relay/IO Module\n"
+    "2) Temperature Sensor\n"
+    "3) Tank Sensor\n"
+    "4) Battery (Virtual)\n"
+    "5) PV Charger\n"
+    "6) Back to Main Menu"
+)
+
 def create_or_edit_config():
 
     # Declare    highest_existing_device_instance = -1
@@ -891,6 +1100,7 @@ def create_or_edit_config():
     """
     config_dir = '/data/setupOptions/external-devices'
     config_path = os.path.join(config_dir, 'optionsSet')
+    initial_config_digest = config_digest(config_path)
 
     os.makedirs(config_dir, exist_ok=True)
 
@@ -921,14 +1131,23 @@ def create_or_edit_config():
     existing_mqtt_password = ''
     existing_loglevel = ''
 
+    def read_global_settings():
+        nonlocal existing_mqtt_broker, existing_mqtt_port, existing_mqtt_username, existing_mqtt_password
+        nonlocal existing_loglevel
+        # Snapshot the MQTT section once instead of a config.get() per field
+        mqtt_values = dict(config.items('MQTT')) if config.has_section('MQTT') else {}
+        existing_loglevel = config.get('Global', 'loglevel', fallback='INFO')
+        existing_mqtt_broker = mqtt_values.get('brokeraddress', 'localhost')
+        existing_mqtt_port = mqtt_values.get('port', '1883')
+        existing_mqtt_username = mqtt_values.get('username', '')
+        existing_mqtt_password = mqtt_values.get('password', '')
+
     def load_existing_config_data():
         # FIX: Make it clear we are modifying the global variables.
         nonlocal highest_existing_device_instance, highest_existing_device_index
         nonlocal highest_relay_module_idx_in_file, highest_temp_sensor_idx_in_file
         nonlocal highest_tank_sensor_idx_in_file, highest_virtual_battery_idx_in_file
         nonlocal highest_pv_charger_idx_in_file
-        nonlocal existing_mqtt_broker, existing_mqtt_port, existing_mqtt_username, existing_mqtt_password
-        nonlocal existing_loglevel
 
         existing_relay_modules_by_index.clear()
         existing_switches_by_module_and_switch_idx.clear()
@@ -938,49 +1157,46 @@ def create_or_edit_config():
         existing_virtual_batteries_by_index.clear()
         existing_pv_chargers_by_index.clear()
         
-        config.read(config_path)
+        load_config(config, config_path)
 
         # FIX: Loglevel is no longer read from config for this script's operation.
         # It is set to DEBUG at the top.
 
-        existing_loglevel = config.get('Global', 'loglevel', fallback='INFO')
-        existing_mqtt_broker = config.get('MQTT', 'brokeraddress', fallback='localhost')
-        existing_mqtt_port = config.get('MQTT', 'port', fallback='1883')
-        existing_mqtt_username = config.get('MQTT', 'username', fallback='')
-        existing_mqtt_password = config.get('MQTT', 'password', fallback='')
+        read_global_settings()
 
         for section in config.sections():
-            if config.has_option(section, 'deviceinstance'):
-                try:
-                    instance = config.getint(section, 'deviceinstance')
-                    if instance > highest_existing_device_instance:
-                        highest_existing_device_instance = instance
-                except ValueError:
-                    pass
-            if config.has_option(section, 'deviceindex'):
-                try:
-                    index = config.getint(section, 'deviceindex')
-                    if index > highest_existing_device_index:
-                        highest_existing_device_index = index
-                except ValueError:
-                    pass
+            # Snapshot the section once; every field below is read from this dict.
+            # Missing deviceinstance/deviceindex fall back to -1 and never raise the highest values.
+            opts = dict(config.items(section))
+            try:
+                instance = int(opts.get('deviceinstance', -1))
+                if instance > highest_existing_device_instance:
+                    highest_existing_device_instance = instance
+            except ValueError:
+                pass
+            try:
+                index = int(opts.get('deviceindex', -1))
+                if index > highest_existing_device_index:
+                    highest_existing_device_index = index
+            except ValueError:
+                pass
 
             if section.startswith('Relay_Module_'):
                 try:
                     module_idx = int(section.split('_')[2])
                     highest_relay_module_idx_in_file = max(highest_relay_module_idx_in_file, module_idx)
                     existing_relay_modules_by_index[module_idx] = {
-                        'serial': config.get(section, 'serial', fallback=''),
-                        'deviceinstance': config.getint(section, 'deviceinstance', fallback=0),
-                        'deviceindex': config.getint(section, 'deviceindex', fallback=0),
-                        'customname': config.get(section, 'customname', fallback=f'Relay Module {module_idx}'),
-                        'numberofswitches': config.getint(section, 'numberofswitches', fallback=0),
-                        'numberofinputs': config.getint(section, 'numberofinputs', fallback=0),
-                        'mqtt_on_state_payload': config.get(section, 'mqtt_on_state_payload', fallback='ON'),
-                        'mqtt_off_state_payload': config.get(section, 'mqtt_off_state_payload', fallback='OFF'),
-                        'mqtt_on_command_payload': config.get(section, 'mqtt_on_command_payload', fallback='ON'),
-                        'mqtt_off_command_payload': config.get(section, 'mqtt_off_command_payload', fallback='OFF'),
-                        'moduleserial': config.get(section, 'moduleserial', fallback=''),
+                        'serial': opts.get('serial', ''),
+                        'deviceinstance': int(opts.get('deviceinstance', 0)),
+                        'deviceindex': int(opts.get('deviceindex', 0)),
+                        'customname': opts.get('customname', f'Relay Module {module_idx}'),
+                        'numberofswitches': int(opts.get('numberofswitches', 0)),
+                        'numberofinputs': int(opts.get('numberofinputs', 0)),
+                        'mqtt_on_state_payload': opts.get('mqtt_on_state_payload', 'ON'),
+                        'mqtt_off_state_payload': opts.get('mqtt_off_state_payload', 'OFF'),
+                        'mqtt_on_command_payload': opts.get('mqtt_on_command_payload', 'ON'),
+                        'mqtt_off_command_payload': opts.get('mqtt_off_command_payload', 'OFF'),
+                        'moduleserial': opts.get('moduleserial', ''),
                     }
                 except (ValueError, IndexError):
                     logger.warning(f"Skipping malformed Relay_Module section: {section}")
@@ -991,10 +1207,10 @@ def create_or_edit_config():
                     module_idx = int(parts[1])
                     switch_idx = int(parts[2])
                     existing_switches_by_module_and_switch_idx[(module_idx, switch_idx)] = {
-                        'customname': config.get(section, 'customname', fallback=f'switch {switch_idx}'),
-                        'group': config.get(section, 'group', fallback=f'Group{module_idx}'),
-                        'mqttstatetopic': config.get(section, 'mqttstatetopic', fallback='path/to/mqtt/topic'),
-                        'mqttcommandtopic': config.get(section, 'mqttcommandtopic', fallback='path/to/mqtt/topic'),
+                        'customname': opts.get('customname', f'switch {switch_idx}'),
+                        'group': opts.get('group', f'Group{module_idx}'),
+                        'mqttstatetopic': opts.get('mqttstatetopic', 'path/to/mqtt/topic'),
+                        'mqttcommandtopic': opts.get('mqttcommandtopic', 'path/to/mqtt/topic'),
                     }
                 except (ValueError, IndexError):
                     logger.warning(f"Skipping malformed switch section: {section}")
@@ -1005,14 +1221,14 @@ def create_or_edit_config():
                     module_idx = int(parts[1])
                     input_idx = int(parts[2])
                     existing_inputs_by_module_and_input_idx[(module_idx, input_idx)] = {
-                        'customname': config.get(section, 'customname', fallback=f'input {input_idx}'),
-                        'serial': config.get(section, 'serial', fallback=''),
-                        'deviceinstance': config.getint(section, 'deviceinstance', fallback=0),
-                        'deviceindex': config.getint(section, 'deviceindex', fallback=0),
-                        'mqttstatetopic': config.get(section, 'mqttstatetopic', fallback='path/to/mqtt/topic'),
-                        'mqtt_on_state_payload': config.get(section, 'mqtt_on_state_payload', fallback='ON'),
-                        'mqtt_off_state_payload': config.get(section, 'mqtt_off_state_payload', fallback='OFF'),
-                        'type': config.get(section, 'type', fallback='disabled'),
+                        'customname': opts.get('customname', f'input {input_idx}'),
+                        'serial': opts.get('serial', ''),
+                        'deviceinstance': int(opts.get('deviceinstance', 0)),
+                        'deviceindex': int(opts.get('deviceindex', 0)),
+                        'mqttstatetopic': opts.get('mqttstatetopic', 'path/to/mqtt/topic'),
+                        'mqtt_on_state_payload': opts.get('mqtt_on_state_payload', 'ON'),
+                        'mqtt_off_state_payload': opts.get('mqtt_off_state_payload', 'OFF'),
+                        'type': opts.get('type', 'disabled'),
                     }
                 except (ValueError, IndexError):
                     logger.warning(f"Skipping malformed input section: {section}")
@@ -1021,7 +1237,7 @@ def create_or_edit_config():
                 try:
                     sensor_idx = int(section.split('_')[2])
                     highest_temp_sensor_idx_in_file = max(highest_temp_sensor_idx_in_file, sensor_idx)
-                    existing_temp_sensors_by_index[sensor_idx] = {key: val for key, val in config.items(section)}
+                    existing_temp_sensors_by_index[sensor_idx] = dict(opts)
                 except (ValueError, IndexError):
                     logger.warning(f"Skipping malformed Temp_Sensor section: {section}")
 
@@ -1029,7 +1245,7 @@ def create_or_edit_config():
                 try:
                     sensor_idx = int(section.split('_')[2])
                     highest_tank_sensor_idx_in_file = max(highest_tank_sensor_idx_in_file, sensor_idx)
-                    existing_tank_sensors_by_index[sensor_idx] = {key: val for key, val in config.items(section)}
+                    existing_tank_sensors_by_index[sensor_idx] = dict(opts)
                 except (ValueError, IndexError):
                     logger.warning(f"Skipping malformed Tank_Sensor section: {section}")
 
@@ -1037,7 +1253,7 @@ def create_or_edit_config():
                 try:
                     battery_idx = int(section.split('_')[2])
                     highest_virtual_battery_idx_in_file = max(highest_virtual_battery_idx_in_file, battery_idx)
-                    existing_virtual_batteries_by_index[battery_idx] = {key: val for key, val in config.items(section)}
+                    existing_virtual_batteries_by_index[battery_idx] = dict(opts)
                 except (ValueError, IndexError):
                     logger.warning(f"Skipping malformed Virtual_Battery section: {section}")
 
@@ -1045,7 +1261,7 @@ def create_or_edit_config():
                 try:
                     pv_charger_idx = int(section.split('_')[2])
                     highest_pv_charger_idx_in_file = max(highest_pv_charger_idx_in_file, pv_charger_idx)
-                    existing_pv_chargers_by_index[pv_charger_idx] = {key: val for key, val in config.items(section)}
+                    existing_pv_chargers_by_index[pv_charger_idx] = dict(opts)
                 except (ValueError, IndexError):
                     logger.warning(f"Skipping malformed Pv_Charger section: {section}")
 
@@ -1057,24 +1273,25 @@ def create_or_edit_config():
             print("2) Create new configuration (WARNING: Existing configuration will be overwritten!)")
             print("3) Delete existing configuration and exit (WARNING: This cannot be undone!)")
 
-            choice = input("Enter your choice (1, 2 or 3): ")
+            choice = _fast_input("Enter your choice (1, 2 or 3): ")
 
             if choice == '1':
                 load_existing_config_data()
                 print("Continuing to existing configuration.")
                 break
             elif choice == '2':
-                confirm = input("Are you absolutely sure you want to overwrite the existing configuration file? This cannot be undone! (yes/no): ")
+                confirm = _ask("Are you absolutely sure you want to overwrite the existing configuration file? This cannot be undone! (yes/no): ")
                 if confirm.lower() == 'yes':
                     os.remove(config_path)
                     print(f"Existing configuration file deleted: {config_path}")
                     file_exists = False
                     config = configparser.ConfigParser()
+                    _CFG_CACHE.pop(config_path, None)
                     break
                 else:
                     print("Creation of new configuration cancelled.")
             elif choice == '3':
-                confirm = input("Are you absolutely sure you want to delete the configuration file? This cannot be undone! (yes/no): ")
+                confirm = _ask("Are you absolutely sure you want to delete the configuration file? This cannot be undone! (yes/no): ")
                 if confirm.lower() == 'yes':
                     os.remove(config_path)
                     print(f"Configuration file deleted: {config_path}")
@@ -1096,16 +1313,9 @@ def create_or_edit_config():
     if not config.has_section('Global'):
         config.add_section('Global')
     # Initialize global device counters if not present
-    if not config.has_option('Global', 'numberofmodules'):
-        config.set('Global', 'numberofmodules', '0')
-    if not config.has_option('Global', 'numberoftempsensors'):
-        config.set('Global', 'numberoftempsensors', '0')
-    if not config.has_option('Global', 'numberoftanksensors'):
-        config.set('Global', 'numberoftanksensors', '0')
-    if not config.has_option('Global', 'numberofvirtualbatteries'):
-        config.set('Global', 'numberofvirtualbatteries', '0')
-    if not config.has_option('Global', 'numberofpvchargers'):
-        config.set('Global', 'numberofpvchargers', '0')
+    for count_key in GLOBAL_DEVICE_COUNT_KEYS.values():
+        if not config.has_option('Global', count_key):
+            config.set('Global', count_key, '0')
     # Set the loglevel in the config file itself
     config.set('Global', 'loglevel', 'INFO')
 
@@ -1127,120 +1337,28 @@ def create_or_edit_config():
     auto_configured_serials_to_info = {}
 
     while True:
-        print("\n--- Main Configuration Menu ---")
-        print("1) Global Settings")
-        print("2) Add New Device")
-        print("3) Edit Existing Device")
-        print("4) Remove Existing Device")
-        print("5) Exit")
+        print(MAIN_MENU_TEXT)
 
-        main_menu_choice = input("Enter your choice: ")
+        main_menu_choice = _fast_input("Enter your choice: ")
 
         if main_menu_choice == '1': # Handle Global Settings
             configure_global_settings(config, existing_loglevel, existing_mqtt_broker, existing_mqtt_port, existing_mqtt_username, existing_mqtt_password)
             # Reload global settings after modification
-            existing_loglevel = config.get('Global', 'loglevel', fallback='INFO')
-            existing_mqtt_broker = config.get('MQTT', 'brokeraddress', fallback='localhost')
-            existing_mqtt_port = config.get('MQTT', 'port', fallback='1883')
-            existing_mqtt_username = config.get('MQTT', 'username', fallback='')
-            existing_mqtt_password = config.get('MQTT', 'password', fallback='')
+            read_global_settings()
             # Auto-save after changing global settings
-            with open(config_path, 'w') as configfile:
-                config.write(configfile)
+            save_config(config, config_path)
             print("Configuration auto-saved.")
 
         elif main_menu_choice == '2': # Add New Device
             while True:
-                print("\n--- Add New Device ---")
-                print("1) Relay/IO Module")
-                print("2) Temperature Sensor")
-                print("3) Tank Sensor")
-                print("4) Battery (Virtual)")
-                print("5) PV Charger")
-                print("6) Back to Main Menu")
+                print(ADD_DEVICE_MENU_TEXT)
 
-                add_device_choice = input("Enter type of device to add: ")
+                add_device_choice = _fast_input("Enter type of device to add: ")
 
                 if add_device_choice == '1':
                     # Ask for discovery before adding a relay module
-                    discovery_choice = input("\nDo you want to try to discover Dingtian/Shelly modules via MQTT for auto-configuration?(yes/no): ").lower()
-                    if discovery_choice == 'yes':
-                        mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-                        # Ensure we use the latest broker info from config
-                        broker_address = config.get('MQTT', 'brokeraddress', fallback='localhost')
-                        port = config.getint('MQTT', 'port', fallback=1883)
-                        username = config.get('MQTT', 'username', fallback='')
-                        password = config.get('MQTT', 'password', fallback='')
-
-                        if not broker_address:
-                            logger.error("\nMQTT Broker address is not set. Cannot perform discovery.")
-                            print("Please configure MQTT details in 'Global Settings' first.")
-                            continue
-
-                        if username:
-                            mqtt_client.username_pw_set(username, password)
-                        try:
-                            print(f"Connecting to MQTT broker at {broker_address}:{port}...")
-                            mqtt_client.connect(broker_address, port, 60)
-                            print("Connected to MQTT broker.")
-                            all_discovered_modules_with_topics = discover_devices_via_mqtt(mqtt_client)
-                            mqtt_client.disconnect()
-                            print("Disconnected from MQTT broker.")
-
-                            newly_discovered_modules_to_propose = {}
-                            skipped_modules_count = 0
-                            for module_serial, module_info in all_discovered_modules_with_topics.items():
-                                is_already_in_config = False
-                                for existing_mod_data in existing_relay_modules_by_index.values():
-                                    if (existing_mod_data.get('serial') == module_serial or
-                                        existing_mod_data.get('moduleserial') == module_serial):
-                                        is_already_in_config = True
-                                        break
-                                if not is_already_in_config:
-                                    newly_discovered_modules_to_propose[module_serial] = module_info
-                                else:
-                                    skipped_modules_count += 1
-                            if skipped_modules_count > 0:
-                                print(f"\nSkipped {skipped_modules_count} discovered modules as they appear to be already configured by serial or moduleserial.")
-
-                            if newly_discovered_modules_to_propose:
-                                print("\n--- Newly Discovered Modules (by Serial Number) ---")
-                                discovered_module_serials_list = sorted(list(newly_discovered_modules_to_propose.keys()))
-                                for i, module_serial in enumerate(discovered_module_serials_list):
-                                    module_info = newly_discovered_modules_to_propose[module_serial]
-                                    print(f"{i+1}) Device Type: {module_info['device_type'].capitalize()}, Module Serial: {module_serial}")
-
-                                selected_indices_input = input("Enter the number of the module you want to auto-configure (e.g., 1,3 or 'all'; enter to skip): ")
-                                selected_serials_for_auto_config = []
-
-                                if selected_indices_input.lower() == 'all':
-                                    selected_serials_for_auto_config = discovered_module_serials_list
-                                else:
-                                    try:
-                                        if selected_indices_input:
-                                            indices = [int(x.strip()) - 1 for x in selected_indices_input.split(',')]
-                                            for idx in indices:
-                                                if 0 <= idx < len(discovered_module_serials_list):
-                                                    selected_serials_for_auto_config.append(discovered_module_serials_list[idx])
-                                                else:
-                                                    print(f"Warning: Invalid selection number {idx+1} ignored.")
-                                    except ValueError:
-                                        print("Invalid input for selection. No specific modules selected for auto-configuration.")
-
-                                if selected_serials_for_auto_config:
-                                    print(f"\n--- Staging Auto-Configuration for Selected Modules ---")
-                                    for module_serial in selected_serials_for_auto_config:
-                                        auto_configured_serials_to_info[module_serial] = newly_discovered_modules_to_propose[module_serial]
-                                        print(f"  Module {module_serial} selected for auto-configuration.")
-                                else:
-                                    print("\nNo specific modules selected for auto-configuration.")
-                            else:
-                                print("\nNo new Dingtian or Shelly modules found via MQTT topic discovery to auto-configure.")
-                        except Exception as e:
-                            logger.error(f"\nCould not connect to MQTT broker or perform discovery: {e}")
-                            print("Proceeding without MQTT discovery for auto-configuration.")
-                    else:
-                        print("\nSkipping MQTT discovery for auto-configuration.")
+                    if not run_relay_module_discovery(config, existing_relay_modules_by_index, auto_configured_serials_to_info):
+                        continue
 
                     # If any modules were selected for auto-configuration, loop and add them all.
                     if auto_configured_serials_to_info:
@@ -1266,13 +1384,13 @@ def create_or_edit_config():
                             
                             # After adding each module, save the file and reload the configuration data.
                             # This is crucial for the next iteration to have the correct state.
-                            with open(config_path, 'w') as configfile:
-                                config.write(configfile)
+                            save_config(config, config_path)
                             print(f"Module with serial {serial} configured and saved.")
                             load_existing_config_data()
 
                         print("\n--- Finished processing all selected auto-discovered modules. ---")
                         auto_configured_serials_to_info.clear() # Clear the staged items.
+                        parse_mqtt_device_topic.cache_clear() # Release the parsed discovery topics.
                     
                     # If the user did not use discovery or did not select any modules, 
                     # proceed with the manual configuration for a single new module.
@@ -1287,8 +1405,7 @@ def create_or_edit_config():
                             highest_existing_device_index=highest_existing_device_index
                         )
                         # Auto-save and reload data after adding the new device
-                        with open(config_path, 'w') as configfile:
-                            config.write(configfile)
+                        save_config(config, config_path)
                         print("Configuration auto-saved.")
                         load_existing_config_data()
 
@@ -1299,8 +1416,7 @@ def create_or_edit_config():
                         highest_existing_device_instance=highest_existing_device_instance,
                         highest_existing_device_index=highest_existing_device_index
                     )
-                    with open(config_path, 'w') as configfile:
-                        config.write(configfile)
+                    save_config(config, config_path)
                     print("Configuration auto-saved.")
                     load_existing_config_data()
                 elif add_device_choice == '3':
@@ -1310,8 +1426,7 @@ def create_or_edit_config():
                         highest_existing_device_instance=highest_existing_device_instance,
                         highest_existing_device_index=highest_existing_device_index
                     )
-                    with open(config_path, 'w') as configfile:
-                        config.write(configfile)
+                    save_config(config, config_path)
                     print("Configuration auto-saved.")
                     load_existing_config_data()
                 elif add_device_choice == '4':
@@ -1321,8 +1436,7 @@ def create_or_edit_config():
                         highest_existing_device_instance=highest_existing_device_instance,
                         highest_existing_device_index=highest_existing_device_index
                     )
-                    with open(config_path, 'w') as configfile:
-                        config.write(configfile)
+                    save_config(config, config_path)
                     print("Configuration auto-saved.")
                     load_existing_config_data()
                 elif add_device_choice == '5':
@@ -1332,8 +1446,7 @@ def create_or_edit_config():
                         highest_existing_device_instance=highest_existing_device_instance,
                         highest_existing_device_index=highest_existing_device_index
                     )
-                    with open(config_path, 'w') as configfile:
-                        config.write(configfile)
+                    save_config(config, config_path)
                     print("Configuration auto-saved.")
                     load_existing_config_data()
                 elif add_device_choice == '6':
@@ -1371,7 +1484,7 @@ def create_or_edit_config():
                     print(f"{i+1}) {section} ({name})")
                 print(f"{len(editable_devices)+1}) Back to Main Menu")
 
-                edit_choice = input("Select a device to edit: ")
+                edit_choice = _fast_input("Select a device to edit: ")
                 try:
                     edit_idx = int(edit_choice) - 1
                     if 0 <= edit_idx < len(editable_devices):
@@ -1417,8 +1530,7 @@ def create_or_edit_config():
                             )
 
                         # Save the configuration *after* the changes have been made.
-                        with open(config_path, 'w') as configfile:
-                            config.write(configfile)
+                        save_config(config, config_path)
                         print("Configuration auto-saved after editing.")
                         
                         load_existing_config_data() # Reload data after editing
@@ -1458,51 +1570,32 @@ def create_or_edit_config():
                     print(f"{i+1}) {section} ({name})")
                 print(f"{len(removable_devices)+1}) Back to Main Menu")
 
-                remove_choice = input("Select a device to remove: ")
+                remove_choice = _fast_input("Select a device to remove: ")
                 try:
                     remove_idx = int(remove_choice) - 1
                     if 0 <= remove_idx < len(removable_devices):
                         selected_section, _, original_idx, dev_type = removable_devices[remove_idx]
-                        confirm = input(f"Are you sure you want to remove {selected_section} ({removable_devices[remove_idx][1]})? (yes/no): ").lower()
+                        confirm = _ask(f"Are you sure you want to remove {selected_section} ({removable_devices[remove_idx][1]})? (yes/no): ").lower()
                         if confirm == 'yes':
                             config.remove_section(selected_section)
                             print(f"Removed section: {selected_section}")
                             if dev_type == 'relay':
-                                sections_to_remove_sub = []
-                                for section_name in config.sections():
-                                    if section_name.startswith(f'switch_{original_idx}_') or section_name.startswith(f'input_{original_idx}_'):
-                                        sections_to_remove_sub.append(section_name)
+                                # Prefixes built once rather than twice per section
+                                sub_section_prefixes = (f'switch_{original_idx}_', f'input_{original_idx}_')
+                                sections_to_remove_sub = [section_name for section_name in config.sections()
+                                                          if section_name.startswith(sub_section_prefixes)]
                                 for sub_section in sections_to_remove_sub:
                                     config.remove_section(sub_section)
                                     print(f"Removed associated section: {sub_section}")
 
-                                current_global_modules = config.getint('Global', 'numberofmodules', fallback=0)
-                                if current_global_modules > 0:
-                                    config.set('Global', 'numberofmodules', str(current_global_modules - 1))
-
-                            elif dev_type == 'temp':
-                                current_global_temp_sensors = config.getint('Global', 'numberoftempsensors', fallback=0)
-                                if current_global_temp_sensors > 0:
-                                    config.set('Global', 'numberoftempsensors', str(current_global_temp_sensors - 1))
-
-                            elif dev_type == 'tank':
-                                current_global_tank_sensors = config.getint('Global', 'numberoftanksensors', fallback=0)
-                                if current_global_tank_sensors > 0:
-                                    config.set('Global', 'numberoftanksensors', str(current_global_tank_sensors - 1))
-
-                            elif dev_type == 'pv':
-                                current_global_pv_chargers = config.getint('Global', 'numberofpvchargers', fallback=0)
-                                if current_global_pv_chargers > 0:
-                                    config.set('Global', 'numberofpvchargers', str(current_global_pv_chargers - 1))
-
-                            elif dev_type == 'battery':
-                                current_global_virtual_batteries = config.getint('Global', 'numberofvirtualbatteries', fallback=0)
-                                if current_global_virtual_batteries > 0:
-                                    config.set('Global', 'numberofvirtualbatteries', str(current_global_virtual_batteries - 1))
+                            count_key = GLOBAL_DEVICE_COUNT_KEYS.get(dev_type)
+                            if count_key:
+                                current_global_count = config.getint('Global', count_key, fallback=0)
+                                if current_global_count > 0:
+                                    config.set('Global', count_key, str(current_global_count - 1))
 
                             # Auto-save after removal
-                            with open(config_path, 'w') as configfile:
-                                config.write(configfile)
+                            save_config(config, config_path)
                             print("Configuration auto-saved after removal.")
 
                             load_existing_config_data() # Reload data after removal
@@ -1518,7 +1611,7 @@ def create_or_edit_config():
                     print("Invalid input. Please enter a number.")
 
         elif main_menu_choice == '5': # Exit
-            service_options_menu()
+            service_options_menu(config_changed=config_digest(config_path) != initial_config_digest)
             return
 
         else:
@@ -1526,4 +1619,8 @@ def create_or_edit_config():
             
 
 if __name__ == "__main__":
-    create_or_edit_config()
+    try:
+        create_or_edit_config()
+    except EOFError:
+        # stdin ran out, e.g. a scripted or non-interactive run reached a menu with no answer left
+        sys.exit("\nEnd of input reached, exiting.")
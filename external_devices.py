@@ -13,6 +13,20 @@ import json
 import re
 import dbus.bus
 import traceback
+import signal
+import functools
+import collections
+import queue
+from types import MappingProxyType
+from math import floor, isfinite
+
+# orjson decodes MQTT payloads several times faster when it is installed; the stdlib is the fallback.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so existing except clauses still match.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 logger = logging.getLogger()
 
@@ -29,6 +43,9 @@ logger.setLevel(logging.DEBUG) # Default to DEBUG for better visibility
 
 CONFIG_FILE_PATH = '/data/setupOptions/external-devices/optionsSet'
 
+# The GLib main loop runs on the thread that starts the script; MQTT messages are handled on the message worker thread
+_MAIN_THREAD = threading.main_thread()
+
 try:
     sys.path.insert(1, "/opt/victronenergy/dbus-systemcalc-py/ext/velib_python")
     from vedbus import VeDbusService
@@ -36,19 +53,240 @@ except ImportError:
     logger.critical("Cannot find vedbus library. Please ensure it's in the correct path.")
     sys.exit(1)
 
-def get_json_attribute(data, path):
-    parts = path.split('.')
+def get_json_attribute(data, parts):
+    # parts is the dotted attribute path already split into a tuple, e.g. ('state', 'relay1')
     current = data
-    for part in parts:
-        if isinstance(current, dict) and part in current:
+    try:
+        for part in parts:
             current = current[part]
-        else:
-            return None
+    except (KeyError, TypeError, IndexError):
+        return None
     return current
 
+@functools.lru_cache(maxsize=1024)
+def is_valid_topic(topic):
+    # Placeholder topics from the config script and wildcard filters can never match a state update
+    return bool(topic) and 'path/to/mqtt' not in topic and '#' not in topic and '+' not in topic
+
+def _r2(x):
+    # Round half up to 2 decimals; plain arithmetic is cheaper than round() on the per-message path
+    return floor(x * 100.0 + 0.5) / 100.0
+
+# A plain decimal number, e.g. b'21.5', b'-3', b'1e3'; checked before float() so junk payloads don't raise
+_FLOAT_RE = re.compile(rb'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*$')
+
+def parse_mqtt_value(payload):
+    # Works on the raw payload bytes: float() and json_loads() both accept bytes, so no decode is needed.
+    # Most payloads are bare numbers; only payloads that look like a JSON object go through json_loads
+    payload = payload.lstrip()
+    if not payload:
+        return None
+    value = None
+    if payload[:1] == b'{':
+        try:
+            incoming_json = json_loads(payload)
+            if isinstance(incoming_json, dict) and "value" in incoming_json:
+                value = float(incoming_json["value"])
+        except (json.JSONDecodeError, UnicodeDecodeError, TypeError, ValueError):
+            pass
+    elif _FLOAT_RE.match(payload):
+        value = float(payload)
+    # nan/inf (e.g. {"value": "nan"} or b'1e999') would break the rounding and level maths downstream
+    if value is None or not isfinite(value):
+        return None
+    return value
+
+def config_file_key(path):
+    # (mtime, size) identifies a version of the file without reading it
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def load_config(path):
+    # Always a fresh parser: callers (main() injecting DeviceIndex) are free to modify it
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+def serialize_config(sections):
+    # Build the whole INI text in memory so a save is a single write() call
+    parts = []
+    for section, options in sections.items():
+        parts.append(f'[{section}]\n')
+        for key, value in options.items():
+            # Embedded newlines become indented continuation lines, as ConfigParser.write does
+            value = str(value).replace('\n', '\n\t')
+            parts.append(f'{key} = {value}\n')
+        parts.append('\n')
+    return ''.join(parts)
+
+def write_config_file(sections):
+    # Write to a temp file and rename over the original, so a crash mid-write never leaves a truncated config
+    tmp_path = CONFIG_FILE_PATH + '.tmp'
+    with open(tmp_path, 'w') as configfile:
+        configfile.write(serialize_config(sections))
+        # Make the data durable before the rename, or a power cut can leave an empty file behind it
+        configfile.flush()
+        os.fsync(configfile.fileno())
+    os.replace(tmp_path, CONFIG_FILE_PATH)
+
+# ====================================================================
+# ConfigStore Class
+# ====================================================================
+class ConfigStore:
+    """
+    In-memory copy of the config file shared by all services. D-Bus changes are
+    applied to it immediately and written to disk by a single delayed flush, so a
+    burst of changes costs one file write instead of a read and write per change.
+    The file is parsed with configparser once; after that the store is a plain
+    dict of sections, so changes and saves don't go through configparser. If the
+    file is edited by someone else while no changes are pending, it is reloaded
+    before the next change so the flush doesn't overwrite those edits.
+    """
+    FLUSH_DELAY_MS = 1000
+
+    def __init__(self):
+        self.sections = None
+        self.file_key = None # (mtime, size) of the file as last loaded or written
+        self.dirty = False
+        self.pending_flush_id = None
+
+    def load(self, config=None):
+        # Takes an already parsed, unmodified config to avoid a second parse at startup
+        if config is None:
+            config = load_config(CONFIG_FILE_PATH)
+        self.sections = {section: dict(config.items(section, raw=True)) for section in config.sections()}
+        self.file_key = config_file_key(CONFIG_FILE_PATH)
+
+    def set(self, section, key, value):
+        try:
+            # One stat per burst of changes; while changes are pending the in-memory copy is authoritative
+            if self.sections is None or (not self.dirty and config_file_key(CONFIG_FILE_PATH) != self.file_key):
+                self.load()
+            # Option names are stored lowercased, as configparser does. Values are kept as raw
+            # file text (loaded with raw=True), so '%' is escaped for the interpolating readers
+            self.sections.setdefault(section, {})[key.lower()] = str(value).replace('%', '%%')
+        except Exception as e:
+            logger.error(f"Failed to apply config change for key '{key}' in section '{section}': {e}")
+            traceback.print_exc()
+            return
+        self.dirty = True
+        if self.pending_flush_id is None:
+            self.pending_flush_id = GLib.timeout_add(self.FLUSH_DELAY_MS, self._flush_timeout)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Queued config change: Section=[{section}], Key='{key}', Value='{value}'")
+
+    def _flush_timeout(self):
+        self.pending_flush_id = None
+        self.flush()
+        return False # Run only once
+
+    def flush(self):
+        if not self.dirty:
+            return
+        try:
+            write_config_file(self.sections)
+            self.file_key = config_file_key(CONFIG_FILE_PATH)
+            self.dirty = False
+            logger.debug(f"Saved config file: {CONFIG_FILE_PATH}")
+        except Exception as e:
+            logger.error(f"Failed to save config file changes: {e}")
+            traceback.print_exc()
+
+config_store = ConfigStore()
+
+# ====================================================================
+# IdleUpdateQueue Class
+# ====================================================================
+class IdleUpdateQueue:
+    """
+    Coalesces D-Bus updates scheduled from the MQTT message worker thread. Only the
+    latest update per key is kept, so the pending set is bounded by the number of
+    keys and never loses the newest value of a path; one GLib idle callback applies
+    them all, so a burst of messages can't flood the main loop with stale updates.
+    Updates scheduled from the GLib thread itself are applied straight away.
+    """
+    __slots__ = ('_lock', '_pending_updates', '_flush_scheduled')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending_updates = {}
+        self._flush_scheduled = False
+
+    def schedule(self, key, func, *args):
+        with self._lock:
+            self._pending_updates[key] = (func, args)
+            if threading.current_thread() is not _MAIN_THREAD:
+                if self._flush_scheduled:
+                    return
+                self._flush_scheduled = True
+                GLib.idle_add(self._flush_pending)
+                return
+        # Already on the GLib thread, apply now along with anything older still pending
+        self._flush_pending()
+
+    def _flush_pending(self):
+        # Swap the dict under the lock; an update scheduled meanwhile lands in the new dict and schedules another flush
+        with self._lock:
+            pending = self._pending_updates
+            self._pending_updates = {}
+            self._flush_scheduled = False
+        for func, args in pending.values():
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Error applying queued D-Bus update via {func.__name__}: {e}")
+                traceback.print_exc()
+        return False # Run only once
+
+# ====================================================================
+# MqttMessageWorker Class
+# ====================================================================
+class MqttMessageWorker:
+    """
+    Takes incoming MQTT messages off the paho network thread. The dispatcher only
+    enqueues; a single daemon thread decodes, matches and routes the messages, so
+    the network thread is free to keep reading the socket and answering keepalives.
+    """
+    MAX_PENDING = 1024 # The oldest message is dropped beyond this
+
+    __slots__ = ('_queue', '_thread')
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=self.MAX_PENDING)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='mqtt-message-worker', daemon=True)
+        self._thread.start()
+
+    def put(self, msg):
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            try:
+                dropped = self._queue.get_nowait()
+                logger.warning(f"MQTT message queue full, dropping oldest message on topic '{dropped.topic}'")
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(msg)
+
+    def _run(self):
+        while True:
+            msg = self._queue.get()
+            try:
+                # One dict lookup finds the pre-bound handler of every service path interested in this topic
+                for handler in MQTT_ROUTES.get(msg.topic, ()):
+                    handler(msg)
+            except Exception as e:
+                logger.error(f"Error handling MQTT message on topic '{msg.topic}': {e}")
+                traceback.print_exc()
+
 # ====================================================================
 # DbusSwitch Class
 # ====================================================================
+# One MQTT-driven switch output: its D-Bus state path and the topics it reads and writes
+SwitchOutput = collections.namedtuple('SwitchOutput', 'dbus_path state_topic command_topic')
+
 class DbusSwitch(VeDbusService):
     def __init__(self, service_name, device_config, output_configs, serial_number, mqtt_client,
                  mqtt_on_state_payload, mqtt_off_state_payload, mqtt_on_command_payload, mqtt_off_command_payload, bus):
@@ -62,6 +300,8 @@ class DbusSwitch(VeDbusService):
         self.mqtt_off_state_payload_raw = mqtt_off_state_payload
         self.mqtt_on_command_payload = mqtt_on_command_payload
         self.mqtt_off_command_payload = mqtt_off_command_payload
+        # QoS for relay commands; commands are dropped rather than queued while the broker is unreachable
+        self.publish_qos = min(max(device_config.getint('PublishQos', 0), 0), 2)
         self.mqtt_on_state_payload_json = None
         self.mqtt_off_state_payload_json = None
 
@@ -79,6 +319,15 @@ class DbusSwitch(VeDbusService):
         except json.JSONDecodeError:
             pass
 
+        # Precomputed per-message matching data: lowercased raw payload bytes -> state (ON wins if both are equal),
+        # and the single (attribute, lowercased value) pair of each JSON state payload
+        self._payload_state_map = {
+            mqtt_off_state_payload.strip().lower().encode(): 0,
+            mqtt_on_state_payload.strip().lower().encode(): 1
+        }
+        self._on_json_match = self._json_match(self.mqtt_on_state_payload_json)
+        self._off_json_match = self._json_match(self.mqtt_off_state_payload_json)
+
         self.add_path('/Mgmt/ProcessName', 'dbus-victron-virtual')
         self.add_path('/Mgmt/ProcessVersion', '0.1.19')
         self.add_path('/Mgmt/Connection', 'Virtual')
@@ -86,6 +335,7 @@ class DbusSwitch(VeDbusService):
         self.add_path('/ProductId', 49257)
         self.add_path('/ProductName', 'Virtual switch')
         self.add_path('/CustomName', self.device_config.get('CustomName'), writeable=True, onchangecallback=self.handle_dbus_change)
+        self._custom_name = self['/CustomName'] # Cached for logging
         self.add_path('/Serial', serial_number)
         self.add_path('/State', 256)
         self.add_path('/FirmwareVersion', 0)
@@ -94,23 +344,35 @@ class DbusSwitch(VeDbusService):
 
         # Use the global MQTT client passed in
         self.mqtt_client = mqtt_client
+        self.update_queue = IdleUpdateQueue() # Coalesces D-Bus updates coming from the MQTT thread
+        # Command topic -> payload, published together once the current burst of D-Bus writes is handled
+        self._pending_commands = {}
+        self._commands_flush_scheduled = False
 
-        self.dbus_path_to_state_topic_map = {}
-        self.dbus_path_to_command_topic_map = {}
+        self.outputs = {} # D-Bus state path -> SwitchOutput, for outputs with valid topics
+        self.dbus_path_meta = {} # Writable output path -> (config section, key name)
         self.mqtt_subscriptions = set() # Store topics this instance cares about
 
         for output_data in output_configs:
             self.add_output(output_data)
+        # Item objects behind the MQTT-driven output states, so updates skip the service's path lookup
+        self._items = {path: self._dbusobjects[path] for path in self.outputs}
 
         self.register() # Register all D-Bus paths at once
-        logger.info(f"Service '{service_name}' for device '{self['/CustomName']}' registered on D-Bus.")
+        logger.info(f"Service '{service_name}' for device '{self._custom_name}' registered on D-Bus.")
+
+        # Collect all unique topics this instance needs to subscribe to (outputs may share a topic)
+        self.mqtt_subscriptions.update(output.state_topic for output in self.outputs.values())
+        for topic in self.mqtt_subscriptions:
+            logger.debug(f"DbusSwitch '{self._custom_name}' will subscribe to topic: {topic}")
 
-        # Collect all unique topics this instance needs to subscribe to
-        for dbus_path, topic in self.dbus_path_to_state_topic_map.items():
-            if topic:
-                self.mqtt_subscriptions.add(topic)
-                logger.debug(f"DbusSwitch '{self['/CustomName']}' will subscribe to topic: {topic}")
 
+    @staticmethod
+    def _json_match(payload_json):
+        if not payload_json:
+            return None
+        attr, val = next(iter(payload_json.items()))
+        return tuple(attr.split('.')), str(val).lower()
 
     def add_output(self, output_data):
         # Construct the output prefix for D-Bus paths
@@ -119,94 +381,92 @@ class DbusSwitch(VeDbusService):
         command_topic = output_data.get('MqttCommandTopic')
         dbus_state_path = f'{output_prefix}/State'
 
-        if state_topic and 'path/to/mqtt' not in state_topic and command_topic and 'path/to/mqtt' not in command_topic:
-            self.dbus_path_to_state_topic_map[dbus_state_path] = state_topic
-            self.dbus_path_to_command_topic_map[dbus_state_path] = command_topic
+        if is_valid_topic(state_topic) and is_valid_topic(command_topic):
+            self.outputs[dbus_state_path] = SwitchOutput(dbus_state_path, state_topic, command_topic)
         else:
             logger.warning(f"MQTT topics for {dbus_state_path} in DbusSwitch are invalid. Ignoring.")
 
+        # Resolve the switch_X_Y section for this output once, so D-Bus callbacks are a dict lookup
+        section_name = f'switch_{self.device_config.get("DeviceIndex")}_{output_data["index"]}'
+        settings_prefix = f'{output_prefix}/Settings'
+        self.dbus_path_meta[dbus_state_path] = (section_name, 'State')
+        self.dbus_path_meta[f'{settings_prefix}/CustomName'] = (section_name, 'CustomName')
+        self.dbus_path_meta[f'{settings_prefix}/Group'] = (section_name, 'Group')
+
         self.add_path(f'{output_prefix}/Name', output_data['name'])
         self.add_path(f'{output_prefix}/Status', 0)
         self.add_path(dbus_state_path, 0, writeable=True, onchangecallback=self.handle_dbus_change)
-        settings_prefix = f'{output_prefix}/Settings'
         self.add_path(f'{settings_prefix}/CustomName', output_data['custom_name'], writeable=True, onchangecallback=self.handle_dbus_change)
         self.add_path(f'{settings_prefix}/Group', output_data['group'], writeable=True, onchangecallback=self.handle_dbus_change)
         self.add_path(f'{settings_prefix}/Type', 1, writeable=True)
         self.add_path(f'{settings_prefix}/ValidTypes', 7)
 
-    def on_mqtt_message_specific(self, client, userdata, msg):
-        if msg.topic not in self.mqtt_subscriptions:
-            return # Not for this instance
-
-        logger.debug(f"DbusSwitch specific MQTT callback triggered for {self['/CustomName']} on topic '{msg.topic}'")
-        try:
-            payload_str = msg.payload.decode().strip()
-            topic = msg.topic
-            new_state = None
+    def mqtt_routes(self):
+        """Returns the (topic, D-Bus path) pairs this service handles."""
+        return [(output.state_topic, dbus_path) for dbus_path, output in self.outputs.items()]
+
+    def handle_mqtt_message(self, dbus_path, msg):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"DbusSwitch specific MQTT callback triggered for {self._custom_name} on topic '{msg.topic}'")
+
+        # Matching works on the payload bytes; only JSON payloads and unrecognized ones are ever decoded
+        topic = msg.topic
+        payload = msg.payload.strip()
+        new_state = None
+        processed_payload_value = payload.lower()
+        # Only payloads that look like a JSON object can match the JSON state payloads
+        if payload[:1] == b'{':
             try:
-                incoming_json = json.loads(payload_str)
-                if self.mqtt_on_state_payload_json:
-                    on_attr, on_val = list(self.mqtt_on_state_payload_json.items())[0]
+                incoming_json = json_loads(payload)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                incoming_json = None
+            if isinstance(incoming_json, dict):
+                if self._on_json_match:
+                    on_attr, on_val = self._on_json_match
                     extracted_on_value = get_json_attribute(incoming_json, on_attr)
-                    if extracted_on_value is not None and str(extracted_on_value).lower() == str(on_val).lower():
+                    if extracted_on_value is not None and str(extracted_on_value).lower() == on_val:
                         new_state = 1
-                if new_state is None and self.mqtt_off_state_payload_json:
-                    off_attr, off_val = list(self.mqtt_off_state_payload_json.items())[0]
+                if new_state is None and self._off_json_match:
+                    off_attr, off_val = self._off_json_match
                     extracted_off_value = get_json_attribute(incoming_json, off_attr)
-                    if extracted_off_value is not None and str(extracted_off_value).lower() == str(off_val).lower():
+                    if extracted_off_value is not None and str(extracted_off_value).lower() == off_val:
                         new_state = 0
-                if new_state is None: # Fallback if JSON key/value not matched, try value in JSON as string
-                    processed_payload_value = str(incoming_json.get("value", payload_str)).lower()
-            except json.JSONDecodeError:
-                # If not JSON, process as raw string
-                processed_payload_value = payload_str.lower()
-            
-            if new_state is None: # If not determined by JSON parsing, try raw string matching
-                if processed_payload_value == self.mqtt_on_state_payload_raw.lower():
-                    new_state = 1
-                elif processed_payload_value == self.mqtt_off_state_payload_raw.lower():
-                    new_state = 0
-                else:
-                    logger.warning(f"DbusSwitch: Unrecognized payload '{payload_str}' for topic '{topic}'. Expected '{self.mqtt_on_state_payload_raw}' or '{self.mqtt_off_state_payload_raw}'.")
-                    return # Exit if state not determined
-
-            dbus_path = next((k for k, v in self.dbus_path_to_state_topic_map.items() if v == topic), None)
-            if dbus_path and self[dbus_path] != new_state:
-                logger.debug(f"DbusSwitch: Updating D-Bus path '{dbus_path}' to {new_state} for '{self['/CustomName']}'.")
-                GLib.idle_add(self.update_dbus_from_mqtt, dbus_path, new_state)
-            elif dbus_path:
-                logger.debug(f"DbusSwitch: D-Bus path '{dbus_path}' already {new_state}. No update needed.")
+                if new_state is None and "value" in incoming_json: # Fallback if JSON key/value not matched, try value in JSON as string
+                    processed_payload_value = str(incoming_json["value"]).lower().encode()
+
+        if new_state is None: # If not determined by JSON parsing, try raw string matching
+            new_state = self._payload_state_map.get(processed_payload_value)
+            if new_state is None:
+                payload_str = payload.decode(errors='replace')
+                logger.warning(f"DbusSwitch: Unrecognized payload '{payload_str}' for topic '{topic}'. Expected '{self.mqtt_on_state_payload_raw}' or '{self.mqtt_off_state_payload_raw}'.")
+                return # Exit if state not determined
 
+        try:
+            if self._items[dbus_path].local_get_value() != new_state:
+                if debug:
+                    logger.debug(f"DbusSwitch: Updating D-Bus path '{dbus_path}' to {new_state} for '{self._custom_name}'.")
+                self.update_queue.schedule(dbus_path, self.update_dbus_from_mqtt, dbus_path, new_state)
+            elif debug:
+                logger.debug(f"DbusSwitch: D-Bus path '{dbus_path}' already {new_state}. No update needed.")
         except Exception as e:
             logger.error(f"Error processing MQTT message for DbusSwitch {self.service_name} on topic {msg.topic}: {e}")
             traceback.print_exc()
 
     def handle_dbus_change(self, path, value):
-        # Determine the correct section name for saving config
-        if "/SwitchableOutput/output_" in path:
+        # Output paths were mapped to their switch_X_Y section and key in add_output
+        meta = self.dbus_path_meta.get(path)
+        if meta:
             try:
-                # Extract output index from path (e.g., /SwitchableOutput/output_1/State -> 1)
-                match = re.search(r'/output_(\d+)/', path)
-                output_index = match.group(1) if match else None
-                if output_index is None:
-                    logger.error(f"Failed to parse output index from D-Bus path: {path}")
-                    return False
-
-                # This instance represents a Relay_Module, saving to its child switch_X_Y section
-                parent_device_index = self.device_config.get('DeviceIndex') # From Relay_Module_X
-                section_name = f'switch_{parent_device_index}_{output_index}'
-                
-                key_name = path.split('/')[-1]
-
-                if "/State" in path:
+                section_name, key_name = meta
+                if key_name == 'State':
                     if value in [0, 1]:
                         self.publish_mqtt_command(path, value)
                         # State is not saved to optionsSet normally, it's dynamic
                         return True
                     return False
-                elif "/Settings" in path:
-                    self.save_config_change(section_name, key_name, value)
-                    return True
+                self.save_config_change(section_name, key_name, value)
+                return True
             except Exception as e:
                 logger.error(f"Error handling D-Bus change for switch output {path}: {e}")
                 traceback.print_exc()
@@ -214,45 +474,54 @@ class DbusSwitch(VeDbusService):
         elif path == '/CustomName':
             # This handles the CustomName of the main DbusSwitch service itself (the Relay_Module)
             # The section name to save to is the one that created this service.
+            self._custom_name = value
             self.save_config_change(self.device_config.name, 'CustomName', value)
             return True
         return False
 
     def save_config_change(self, section, key, value):
-        config = configparser.ConfigParser()
-        try:
-            config.read(CONFIG_FILE_PATH)
-            if not config.has_section(section):
-                config.add_section(section)
-            config.set(section, key, str(value))
-            with open(CONFIG_FILE_PATH, 'w') as configfile:
-                config.write(configfile)
-            logger.debug(f"Saved config: Section=[{section}], Key='{key}', Value='{value}'")
-        except Exception as e:
-            logger.error(f"Failed to save config file changes for key '{key}': {e}")
-            traceback.print_exc()
+        config_store.set(section, key, value)
 
     def publish_mqtt_command(self, path, value):
-        if not self.mqtt_client or not self.mqtt_client.is_connected():
-            logger.warning(f"MQTT client not connected, cannot publish command for {self.service_name}.")
-            return
-        if path not in self.dbus_path_to_command_topic_map:
+        output = self.outputs.get(path)
+        if output is None:
             logger.warning(f"No command topic mapped for D-Bus path '{path}' in {self.service_name}.")
             return
-        try:
-            command_topic = self.dbus_path_to_command_topic_map[path]
-            mqtt_payload = self.mqtt_on_command_payload if value == 1 else self.mqtt_off_command_payload
-            self.mqtt_client.publish(command_topic, mqtt_payload, retain=False)
-            logger.debug(f"Published MQTT command '{mqtt_payload}' to topic '{command_topic}' for {self.service_name}.")
-        except Exception as e:
-            logger.error(f"Error during MQTT publish for {self.service_name}: {e}")
-            traceback.print_exc()
+        # Queue the command; a group action toggling many outputs is published in one go, and
+        # repeated writes to the same output before the flush only send the last state
+        self._pending_commands[output.command_topic] = self.mqtt_on_command_payload if value == 1 else self.mqtt_off_command_payload
+        if not self._commands_flush_scheduled:
+            self._commands_flush_scheduled = True
+            GLib.idle_add(self._flush_commands)
+
+    def _flush_commands(self):
+        self._commands_flush_scheduled = False
+        pending, self._pending_commands = self._pending_commands, {}
+        # Relay commands are only meaningful now: never let paho hold them for replay after a reconnect,
+        # which could switch relays to a stale state minutes later
+        if not self.mqtt_client.is_connected():
+            logger.warning(f"MQTT client not connected, dropping {len(pending)} command(s) for {self.service_name}.")
+            return False
+        for command_topic, mqtt_payload in pending.items():
+            try:
+                result = self.mqtt_client.publish(command_topic, mqtt_payload, qos=self.publish_qos, retain=False)
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logger.warning(f"Failed to publish command to '{command_topic}' for {self.service_name}: {mqtt.error_string(result.rc)} (rc={result.rc})")
+                    continue
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Published MQTT command '{mqtt_payload}' to topic '{command_topic}' for {self.service_name}.")
+            except Exception as e:
+                logger.error(f"Error during MQTT publish for {self.service_name}: {e}")
+                traceback.print_exc()
+        return False # Run only once
 
     def update_dbus_from_mqtt(self, path, value):
         try:
-            if self[path] != value:
-                self[path] = value
-                logger.debug(f"DbusSwitch: D-Bus path '{path}' updated to {value}.")
+            item = self._items[path]
+            if item.local_get_value() != value:
+                item.local_set_value(value)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"DbusSwitch: D-Bus path '{path}' updated to {value}.")
         except Exception as e:
             logger.error(f"Error updating D-Bus path '{path}' in DbusSwitch: {e}")
             traceback.print_exc()
@@ -263,7 +532,7 @@ class DbusSwitch(VeDbusService):
 # ====================================================================
 class DbusDigitalInput(VeDbusService):
     # Added mapping for text to integer conversion
-    DIGITAL_INPUT_TYPES = {
+    DIGITAL_INPUT_TYPES = MappingProxyType({
         'disabled': 0,
         'pulse meter': 1,
         'door alarm': 2,
@@ -275,7 +544,8 @@ class DbusDigitalInput(VeDbusService):
         'co2 alarm': 8,
         'generator': 9,
         'touch input control': 10
-    }
+    })
+    DIGITAL_INPUT_TYPES_REV = MappingProxyType({v: k for k, v in DIGITAL_INPUT_TYPES.items()})
 
     def __init__(self, service_name, device_config, serial_number, mqtt_client, bus):
         # Pass the bus instance to the parent constructor
@@ -299,6 +569,7 @@ class DbusDigitalInput(VeDbusService):
 
         # Writable paths with callbacks
         self.add_path('/CustomName', self.device_config.get('CustomName', 'Digital Input'), writeable=True, onchangecallback=self.handle_dbus_change)
+        self._custom_name = self['/CustomName'] # Cached for logging
         self.add_path('/Count', self.device_config.getint('Count', 0), writeable=True, onchangecallback=self.handle_dbus_change)
         self.add_path('/State', self.device_config.getint('State', 0), writeable=True, onchangecallback=self.handle_dbus_change)
         
@@ -317,66 +588,69 @@ class DbusDigitalInput(VeDbusService):
         self.add_path('/Connected', 1)
         self.add_path('/InputState', 0)
         self.add_path('/Alarm', 0)
+        # Item objects read and written per message, so updates skip the service's path lookup
+        self._items = {path: self._dbusobjects[path] for path in ('/InputState', '/State', '/Settings/InvertTranslation')}
 
         # Use the global MQTT client passed in
         self.mqtt_client = mqtt_client
+        self.update_queue = IdleUpdateQueue() # Coalesces D-Bus updates coming from the MQTT thread
 
         self.mqtt_state_topic = self.device_config.get('MqttStateTopic')
         self.mqtt_on_payload = self.device_config.get('mqtt_on_state_payload', 'ON')
         self.mqtt_off_payload = self.device_config.get('mqtt_off_state_payload', 'OFF')
+        # Lowercased payload bytes -> raw state, so each message is a single dict lookup
+        self._state_map = {
+            self.mqtt_on_payload.strip().lower().encode(): 1,
+            self.mqtt_off_payload.strip().lower().encode(): 0
+        }
 
         self.mqtt_subscriptions = set() # Store topics this instance cares about
-        if self.mqtt_state_topic and 'path/to/mqtt' not in self.mqtt_state_topic:
+        if is_valid_topic(self.mqtt_state_topic):
             self.mqtt_subscriptions.add(self.mqtt_state_topic)
-            logger.debug(f"DbusDigitalInput '{self['/CustomName']}' will subscribe to topic: {self.mqtt_state_topic}")
+            logger.debug(f"DbusDigitalInput '{self._custom_name}' will subscribe to topic: {self.mqtt_state_topic}")
         else:
-            logger.warning(f"No valid MqttStateTopic for '{self['/CustomName']}'. State will not update from MQTT.")
+            logger.warning(f"No valid MqttStateTopic for '{self._custom_name}'. State will not update from MQTT.")
 
         self.register() # Register D-Bus paths
 
-        logger.info(f"Service '{service_name}' for device '{self['/CustomName']}' registered on D-Bus.")
+        logger.info(f"Service '{service_name}' for device '{self._custom_name}' registered on D-Bus.")
 
-    # Specific message handler for this digital input
-    def on_mqtt_message_specific(self, client, userdata, msg):
-        if msg.topic not in self.mqtt_subscriptions:
-            return # Not for this instance
+    def mqtt_routes(self):
+        """Returns the (topic, D-Bus path) pairs this service handles."""
+        return [(topic, '/InputState') for topic in self.mqtt_subscriptions]
 
-        logger.debug(f"DbusDigitalInput specific MQTT callback triggered for {self['/CustomName']} on topic '{msg.topic}'")
-        
-        if msg.topic != self.mqtt_state_topic:
-            logger.debug(f"DbusDigitalInput: Received message on non-matching topic '{msg.topic}'. Expected '{self.mqtt_state_topic}'.")
+    def handle_mqtt_message(self, dbus_path, msg):
+        # A digital input has a single state topic; both /InputState and /State follow from it
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"DbusDigitalInput: Received MQTT message for {self._custom_name} on topic '{msg.topic}': {msg.payload}")
+
+        raw_state = self._state_map.get(msg.payload.strip().lower())
+        if raw_state is None:
+            payload_str = msg.payload.decode(errors='replace').strip()
+            logger.warning(f"DbusDigitalInput: Invalid MQTT payload '{payload_str}' received for '{self._custom_name}'. Expected '{self.mqtt_on_payload}' or '{self.mqtt_off_payload}'.")
             return
-        
-        try:
-            payload_str = msg.payload.decode().strip()
-            logger.debug(f"DbusDigitalInput: Received MQTT message on topic '{msg.topic}': {payload_str}")
-
-            raw_state = None
-            if payload_str.lower() == self.mqtt_on_payload.lower():
-                raw_state = 1
-            elif payload_str.lower() == self.mqtt_off_payload.lower():
-                raw_state = 0
-            
-            if raw_state is None:
-                logger.warning(f"DbusDigitalInput: Invalid MQTT payload '{payload_str}' received for '{self['/CustomName']}'. Expected '{self.mqtt_on_payload}' or '{self.mqtt_off_payload}'.")
-                return
 
+        try:
             # InputState always reflects the actual (raw) state
-            if self['/InputState'] != raw_state:
-                logger.debug(f"DbusDigitalInput: Updating /InputState for '{self['/CustomName']}' to {raw_state}")
-                GLib.idle_add(self.update_dbus_input_state, raw_state)
+            items = self._items
+            if items['/InputState'].local_get_value() != raw_state:
+                if debug:
+                    logger.debug(f"DbusDigitalInput: Updating /InputState for '{self._custom_name}' to {raw_state}")
+                self.update_queue.schedule('/InputState', self.update_dbus_input_state, raw_state)
 
             # Apply inversion for the main State D-Bus path
-            invert = self['/Settings/InvertTranslation']
+            invert = items['/Settings/InvertTranslation'].local_get_value()
             final_state = (1 - raw_state) if invert == 1 else raw_state
 
             # Get the D-Bus State value based on the Type setting
             dbus_state = self._get_dbus_state_for_type(final_state)
 
             # Schedule D-Bus update for the main State in main thread
-            if self['/State'] != dbus_state:
-                logger.debug(f"DbusDigitalInput: Updating /State for '{self['/CustomName']}' to {dbus_state}")
-                GLib.idle_add(self.update_dbus_state, dbus_state)
+            if items['/State'].local_get_value() != dbus_state:
+                if debug:
+                    logger.debug(f"DbusDigitalInput: Updating /State for '{self._custom_name}' to {dbus_state}")
+                self.update_queue.schedule('/State', self.update_dbus_state, dbus_state)
 
         except Exception as e:
             logger.error(f"Error processing MQTT message for Digital Input {self.service_name} on topic {msg.topic}: {e}")
@@ -401,21 +675,24 @@ class DbusDigitalInput(VeDbusService):
         return logical_state
 
     def update_dbus_input_state(self, new_raw_state):
-        self['/InputState'] = new_raw_state
+        self._items['/InputState'].local_set_value(new_raw_state)
         return False # Run only once
 
     def update_dbus_state(self, new_state_value):
-        self['/State'] = new_state_value
+        self._items['/State'].local_set_value(new_state_value)
         return False # Run only once
 
     def handle_dbus_change(self, path, value):
         try:
             key_name = path.split('/')[-1]
-            logger.debug(f"D-Bus settings change triggered for {path} with value '{value}'. Saving to config file.")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"D-Bus settings change triggered for {path} with value '{value}'. Saving to config file.")
             
             value_to_save = value
-            if path == '/Type':
-                value_to_save = next((name for name, num in self.DIGITAL_INPUT_TYPES.items() if num == value), 'disabled')
+            if path == '/CustomName':
+                self._custom_name = value
+            elif path == '/Type':
+                value_to_save = self.DIGITAL_INPUT_TYPES_REV.get(value, 'disabled')
             
             # Special handling for Alarm settings as they are under /Settings
             if path.startswith('/Settings/'):
@@ -426,7 +703,7 @@ class DbusDigitalInput(VeDbusService):
                     new_invert_setting = value # 'value' is the new InvertTranslation setting (0 or 1)
                     final_state_after_inversion = (1 - current_raw_state) if new_invert_setting == 1 else current_raw_state
                     new_dbus_state_value = self._get_dbus_state_for_type(final_state_after_inversion)
-                    GLib.idle_add(self.update_dbus_state, new_dbus_state_value)
+                    self.update_queue.schedule('/State', self.update_dbus_state, new_dbus_state_value)
             else: # For paths directly under the device root (CustomName, Count, State, Type)
                 self.save_config_change(self.config_section_name, key_name, value_to_save)
             return True
@@ -436,203 +713,246 @@ class DbusDigitalInput(VeDbusService):
             return False
 
     def save_config_change(self, section, key, value):
-        config = configparser.ConfigParser()
-        try:
-            config.read(CONFIG_FILE_PATH)
-            if not config.has_section(section):
-                config.add_section(section)
-            config.set(section, key, str(value))
-            with open(CONFIG_FILE_PATH, 'w') as configfile:
-                config.write(configfile)
-            logger.debug(f"Saved config: Section=[{section}], Key='{key}', Value='{value}'")
-        except Exception as e:
-            logger.error(f"Failed to save config file changes for key '{key}' in section '{section}': {e}")
-            traceback.print_exc()
+        config_store.set(section, key, value)
 
 # ====================================================================
-# DbusTempSensor Class
+# DbusMqttServiceBase Class
 # ====================================================================
-class DbusTempSensor(VeDbusService):
-    TEMPERATURE_TYPES = {
-        'battery': 0,
-        'fridge': 1,
-        'generic': 2,
-        'room': 3,
-        'outdoor': 4,
-        'water heater': 5,
-        'freezer': 6
-    }
+class DbusMqttServiceBase(VeDbusService):
+    """
+    Shared base for the sensor-style services (temperature, tank, battery and PV
+    charger). Each maps MQTT state topics to D-Bus paths and writes the parsed
+    value of every incoming message to its path. Subclasses set the product
+    details, declare their topic-driven paths in TOPIC_SPEC/OPTIONAL_TOPIC_SPEC
+    and add any other paths in add_device_paths().
+    """
+    PRODUCT_ID = None
+    PRODUCT_NAME = None
+    PROCESS_VERSION = '0.1.19'
+    SECTION_PREFIX = None # Config section name without the index, e.g. 'Temp_Sensor'
+    PATH_PARSERS = {} # D-Bus path -> callable(payload bytes) tried before numeric parsing
+    NUMERIC_PATHS = frozenset() # Paths that almost always carry a bare number; tried with float() first
+    # Every change is published by default; a '<Name>MinChange' option next to a '<Name>StateTopic' option
+    # opts that path into ignoring changes smaller than the given amount
+    # (dbus_path, config_key, default) per topic-driven path; optional paths only exist when their topic is valid
+    TOPIC_SPEC = ()
+    OPTIONAL_TOPIC_SPEC = ()
 
     def __init__(self, service_name, device_config, serial_number, mqtt_client, bus):
         # Pass the bus instance to the parent constructor
         super().__init__(service_name, bus=bus, register=False)
-
         self.device_config = device_config
         self.device_index = device_config.getint('DeviceIndex')
         self.service_name = service_name # Store service_name for logging
+        self.section_name = f'{self.SECTION_PREFIX}_{self.device_index}'
 
         # General device settings
         self.add_path('/Mgmt/ProcessName', 'dbus-victron-virtual')
-        self.add_path('/Mgmt/ProcessVersion', '0.1.19')
+        self.add_path('/Mgmt/ProcessVersion', self.PROCESS_VERSION)
         self.add_path('/Mgmt/Connection', 'Virtual')
-        
+
         self.add_path('/DeviceInstance', self.device_config.getint('DeviceInstance'))
-        self.add_path('/ProductId', 49248) # Product ID for virtual temperature sensor
-        self.add_path('/ProductName', 'Virtual temperature') # Fixed product name
+        self.add_path('/ProductId', self.PRODUCT_ID)
+        self.add_path('/ProductName', self.PRODUCT_NAME)
         self.add_path('/CustomName', self.device_config.get('CustomName'), writeable=True, onchangecallback=self.handle_dbus_change)
+        self._custom_name = self['/CustomName'] # Cached for logging
         self.add_path('/Serial', serial_number)
-        
-        self.add_path('/Status', 0) # 0 for OK
-        self.add_path('/Connected', 1) # 1 for connected
-
-        # Temperature specific paths
-        self.add_path('/Temperature', 0.0) # Initial temperature
-        
-        def is_valid_topic(topic):
-            return topic is not None and topic != '' and 'path/to/mqtt' not in topic
-
-        # Conditionally add battery and humidity paths based on valid topics
-        battery_topic = self.device_config.get('BatteryStateTopic')
-        if is_valid_topic(battery_topic):
-            self.add_path('/BatteryVoltage', 0.0) # Initial BatteryVoltage
-
-        humidity_topic = self.device_config.get('HumidityStateTopic')
-        if is_valid_topic(humidity_topic):
-            self.add_path('/Humidity', 0.0) # Initial Humidity
-
-        # TemperatureType mapping and D-Bus path
-        initial_type_str = self.device_config.get('Type', 'generic').lower()
-        initial_type_int = self.TEMPERATURE_TYPES.get(initial_type_str, self.TEMPERATURE_TYPES['generic'])
-        self.add_path('/TemperatureType', initial_type_int, writeable=True, onchangecallback=self.handle_dbus_change)
 
         # Use the global MQTT client passed in
         self.mqtt_client = mqtt_client
-        
-        self.dbus_path_to_state_topic_map = {
-            '/Temperature': self.device_config.get('TemperatureStateTopic'),
-            '/Humidity': self.device_config.get('HumidityStateTopic'),
-            '/BatteryVoltage': self.device_config.get('BatteryStateTopic')
-        }
+        self.update_queue = IdleUpdateQueue() # Coalesces D-Bus updates coming from the MQTT thread
+        self.dbus_path_to_state_topic_map = {}
+        self.path_tolerance = {} # D-Bus path -> smallest change worth publishing, from MinChange options
 
-        # Remove None, empty, or 'path/to/mqtt' values from the map
-        self.dbus_path_to_state_topic_map = {
-            k: v for k, v in self.dbus_path_to_state_topic_map.items()
-            if v is not None and v != '' and 'path/to/mqtt' not in v
-        }
+        self.add_device_paths()
+        self.add_topic_paths(self.TOPIC_SPEC)
+        self.add_topic_paths(self.OPTIONAL_TOPIC_SPEC, optional=True)
+        # Item objects behind the MQTT-driven paths, so updates skip the service's path lookup
+        self._items = {path: self._dbusobjects[path] for path in self.dbus_path_to_state_topic_map}
 
+        self.topic_to_dbus_path = {v: k for k, v in self.dbus_path_to_state_topic_map.items()} # Reverse map for O(1) dispatch
         self.mqtt_subscriptions = set(self.dbus_path_to_state_topic_map.values()) # Store topics this instance cares about
         for topic in self.mqtt_subscriptions:
-            logger.debug(f"DbusTempSensor '{self['/CustomName']}' will subscribe to topic: {topic}")
-
+            logger.debug(f"{self.__class__.__name__} '{self._custom_name}' will subscribe to topic: {topic}")
 
         self.register() # Register D-Bus paths
 
-        logger.info(f"Service '{service_name}' for device '{self['/CustomName']}' registered on D-Bus.")
+        logger.info(f"Service '{service_name}' for device '{self._custom_name}' registered on D-Bus.")
 
-    # Specific message handler for this temp sensor
-    def on_mqtt_message_specific(self, client, userdata, msg):
-        if msg.topic not in self.mqtt_subscriptions:
-            return # Not for this instance
+    def add_device_paths(self):
+        """Adds the device specific D-Bus paths not covered by the topic specs."""
+        pass
 
-        logger.debug(f"DbusTempSensor specific MQTT callback triggered for {self['/CustomName']} on topic '{msg.topic}'")
+    def add_topic_paths(self, paths_spec, optional=False):
+        """
+        Adds a D-Bus path for each (dbus_path, config_key, default) entry and maps it
+        to the entry's state topic when that topic is valid. Optional paths are only
+        added when they have a valid topic.
+        """
+        for dbus_path, cfg_key, default in paths_spec:
+            topic = self.device_config.get(cfg_key)
+            valid = is_valid_topic(topic)
+            if valid or not optional:
+                self.add_path(dbus_path, default)
+            if valid:
+                self.dbus_path_to_state_topic_map[dbus_path] = topic
+                if cfg_key.endswith('StateTopic'):
+                    self.add_min_change(dbus_path, cfg_key[:-len('StateTopic')] + 'MinChange')
+
+    def add_min_change(self, dbus_path, option):
+        min_change = self.device_config.get(option)
+        if not min_change:
+            return
         try:
-            payload_str = msg.payload.decode().strip()
-            topic = msg.topic
-            dbus_path = next((k for k, v in self.dbus_path_to_state_topic_map.items() if v == topic), None)
-            
-            if not dbus_path:
-                logger.debug(f"DbusTempSensor: Received message on non-matching topic '{msg.topic}'. Not mapped for this sensor.")
-                return
+            tolerance = float(min_change)
+        except ValueError:
+            logger.warning(f"{self.__class__.__name__}: Invalid {option} '{min_change}' in [{self.section_name}]. Ignoring.")
+            return
+        self.path_tolerance[dbus_path] = tolerance
+
+    def mqtt_routes(self):
+        """Returns the (topic, D-Bus path) pairs this service handles."""
+        return self.topic_to_dbus_path.items()
 
-            value = None
+    def handle_mqtt_message(self, dbus_path, msg):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self.__class__.__name__} specific MQTT callback triggered for {self._custom_name} on topic '{msg.topic}'")
+        value = None
+        if dbus_path in self.NUMERIC_PATHS:
             try:
-                incoming_json = json.loads(payload_str)
-                if isinstance(incoming_json, dict) and "value" in incoming_json:
-                    value = float(incoming_json["value"])
-                else:
-                    logger.warning(f"DbusTempSensor: JSON payload for topic '{topic}' does not contain 'value' key or is not a dict.")
-                    return
-            except json.JSONDecodeError:
-                try:
-                    value = float(payload_str)
-                except ValueError:
-                    logger.warning(f"DbusTempSensor: Payload '{payload_str}' for topic '{topic}' is not valid float or JSON.")
-                    return
-            
-            if value is None: 
-                logger.warning(f"DbusTempSensor: Could not extract valid numerical value from payload '{payload_str}' for topic '{topic}'.")
-                return
-            
-            if self[dbus_path] != value:
-                logger.debug(f"DbusTempSensor: Updating D-Bus path '{dbus_path}' to {value} for '{self['/CustomName']}'.")
-                GLib.idle_add(self.update_dbus_from_mqtt, dbus_path, value)
+                value = float(msg.payload)
+            except ValueError:
+                pass # Fall back to the general parser, e.g. for a JSON payload
             else:
-                logger.debug(f"DbusTempSensor: D-Bus path '{dbus_path}' already {value}. No update needed.")
+                if not isfinite(value):
+                    value = None # float() accepts b'nan' and b'inf'; let the general parser reject them
+        else:
+            parser = self.PATH_PARSERS.get(dbus_path)
+            if parser:
+                value = parser(msg.payload)
+        if value is None:
+            value = parse_mqtt_value(msg.payload)
+        if value is None:
+            payload_str = msg.payload.decode(errors='replace').strip()
+            logger.warning(f"{self.__class__.__name__}: Could not extract valid value from payload '{payload_str}' for topic '{msg.topic}'.")
+            return
 
+        try:
+            self.handle_mqtt_value(dbus_path, value)
         except Exception as e:
-            logger.error(f"Error processing MQTT message for TempSensor {self.service_name} on topic {msg.topic}: {e}")
+            logger.error(f"Error processing MQTT message for {self.__class__.__name__} {self.service_name} on topic {msg.topic}: {e}")
             traceback.print_exc()
-            
+
+    def handle_mqtt_value(self, dbus_path, value):
+        current = self._items[dbus_path].local_get_value()
+        tolerance = self.path_tolerance.get(dbus_path)
+        if tolerance is None:
+            changed = current != value
+        else:
+            # Ignore sensor jitter that would otherwise cost a D-Bus signal per message
+            changed = current is None or abs(current - value) > tolerance
+        if changed:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{self.__class__.__name__}: Updating D-Bus path '{dbus_path}' to {value} for '{self._custom_name}'.")
+            self.update_queue.schedule(dbus_path, self.update_dbus_from_mqtt, dbus_path, value)
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self.__class__.__name__}: D-Bus path '{dbus_path}' already {value}. No update needed.")
+
     def handle_dbus_change(self, path, value):
-        section_name = f'Temp_Sensor_{self.device_index}'
         if path == '/CustomName':
-            self.save_config_change(section_name, 'CustomName', value)
-            return True
-        elif path == '/TemperatureType':
-            type_str = next((k for k, v in self.TEMPERATURE_TYPES.items() if v == value), 'generic')
-            self.save_config_change(section_name, 'Type', type_str)
+            self._custom_name = value
+            self.save_config_change(self.section_name, 'CustomName', value)
             return True
         return False
 
     def save_config_change(self, section, key, value):
-        config = configparser.ConfigParser()
-        try:
-            config.read(CONFIG_FILE_PATH)
-            if not config.has_section(section):
-                config.add_section(section)
-            config.set(section, key, str(value))
-            with open(CONFIG_FILE_PATH, 'w') as configfile:
-                config.write(configfile)
-            logger.debug(f"Saved config: Section=[{section}], Key='{key}', Value='{value}'")
-        except Exception as e:
-            logger.error(f"Failed to save config file changes for TempSensor key '{key}': {e}")
-            traceback.print_exc()
+        config_store.set(section, key, value)
 
     def update_dbus_from_mqtt(self, path, value):
-        self[path] = value
+        self._items[path].local_set_value(value)
         return False
 
+# ====================================================================
+# DbusTempSensor Class
+# ====================================================================
+class DbusTempSensor(DbusMqttServiceBase):
+    PRODUCT_ID = 49248 # Product ID for virtual temperature sensor
+    PRODUCT_NAME = 'Virtual temperature'
+    SECTION_PREFIX = 'Temp_Sensor'
+
+    TEMPERATURE_TYPES = MappingProxyType({
+        'battery': 0,
+        'fridge': 1,
+        'generic': 2,
+        'room': 3,
+        'outdoor': 4,
+        'water heater': 5,
+        'freezer': 6
+    })
+    TEMPERATURE_TYPES_REV = MappingProxyType({v: k for k, v in TEMPERATURE_TYPES.items()})
+
+    TOPIC_SPEC = (
+        ('/Temperature', 'TemperatureStateTopic', 0.0),
+    )
+    # Battery and humidity paths only exist when they have a valid topic
+    OPTIONAL_TOPIC_SPEC = (
+        ('/BatteryVoltage', 'BatteryStateTopic', 0.0),
+        ('/Humidity', 'HumidityStateTopic', 0.0)
+    )
+    NUMERIC_PATHS = frozenset({'/Temperature', '/BatteryVoltage', '/Humidity'})
+
+    def add_device_paths(self):
+        self.add_path('/Status', 0) # 0 for OK
+        self.add_path('/Connected', 1) # 1 for connected
+
+        # TemperatureType mapping and D-Bus path
+        initial_type_str = self.device_config.get('Type', 'generic').lower()
+        initial_type_int = self.TEMPERATURE_TYPES.get(initial_type_str, self.TEMPERATURE_TYPES['generic'])
+        self.add_path('/TemperatureType', initial_type_int, writeable=True, onchangecallback=self.handle_dbus_change)
+
+    def handle_dbus_change(self, path, value):
+        if path == '/TemperatureType':
+            type_str = self.TEMPERATURE_TYPES_REV.get(value, 'generic')
+            self.save_config_change(self.section_name, 'Type', type_str)
+            return True
+        return super().handle_dbus_change(path, value)
+
 # ====================================================================
 # DbusTankSensor Class
 # ====================================================================
-class DbusTankSensor(VeDbusService):
-    FLUID_TYPES = {
+class DbusTankSensor(DbusMqttServiceBase):
+    PRODUCT_ID = 49251
+    PRODUCT_NAME = 'Virtual tank'
+    SECTION_PREFIX = 'Tank_Sensor'
+
+    FLUID_TYPES = MappingProxyType({
         'fuel': 0, 'fresh water': 1, 'waste water': 2, 'live well': 3, 'oil': 4,
         'black water': 5, 'gasoline': 6, 'diesel': 7, 'lpg': 8, 'lng': 9,
         'hydraulic oil': 10, 'raw water': 11
-    }
+    })
+    FLUID_TYPES_REV = MappingProxyType({v: k for k, v in FLUID_TYPES.items()})
+
+    # Level comes from either the raw value or the level topic, see add_device_paths
+    OPTIONAL_TOPIC_SPEC = (
+        ('/Temperature', 'TemperatureStateTopic', 0.0),
+        ('/BatteryVoltage', 'BatteryStateTopic', 0.0)
+    )
+    NUMERIC_PATHS = frozenset({'/RawValue', '/Level'})
 
     def __init__(self, service_name, device_config, serial_number, mqtt_client, bus):
-        # Pass the bus instance to the parent constructor
-        super().__init__(service_name, bus=bus, register=False)
-        self.device_config = device_config
-        self.device_index = device_config.getint('DeviceIndex')
-        self.service_name = service_name # Store service_name for logging
+        super().__init__(service_name, device_config, serial_number, mqtt_client, bus)
 
-        self.add_path('/Mgmt/ProcessName', 'dbus-victron-virtual')
-        self.add_path('/Mgmt/ProcessVersion', '0.1.19')
-        self.add_path('/Mgmt/Connection', 'Virtual')
-        
-        self.add_path('/DeviceInstance', self.device_config.getint('DeviceInstance'))
-        self.add_path('/ProductId', 49251)
-        self.add_path('/ProductName', 'Virtual tank')
-        self.add_path('/CustomName', self.device_config.get('CustomName'), writeable=True, onchangecallback=self.handle_dbus_change)
-        self.add_path('/Serial', serial_number)
-        
+        # Initial calculations
+        if not self.is_level_direct:
+            self._calculate_level_from_raw_value()
+        self._calculate_remaining_from_level()
+
+    def add_device_paths(self):
         self.add_path('/Status', 0)
         self.add_path('/Connected', 1)
 
         self.add_path('/Capacity', self.device_config.getfloat('Capacity', 0.2), writeable=True, onchangecallback=self.handle_dbus_change)
+        self._capacity = self['/Capacity'] # Cached for the remaining calculation
         
         initial_fluid_type_str = self.device_config.get('FluidType', 'fresh water').lower()
         initial_fluid_type_int = self.FLUID_TYPES.get(initial_fluid_type_str, self.FLUID_TYPES['fresh water'])
@@ -643,113 +963,53 @@ class DbusTankSensor(VeDbusService):
         self.add_path('/RawValue', 0.0)
         self.add_path('/RawValueEmpty', self.device_config.getfloat('RawValueEmpty', 0.0), writeable=True, onchangecallback=self.handle_dbus_change)
         self.add_path('/RawValueFull', self.device_config.getfloat('RawValueFull', 0.0), writeable=True, onchangecallback=self.handle_dbus_change)
+        # Calibration is cached so level calculation doesn't read it back from D-Bus on every sample
+        self._set_raw_calibration(self['/RawValueEmpty'], self['/RawValueFull'])
         
         # Other paths not yet implemented via MQTT
         self.add_path('/RawUnit', self.device_config.get('RawUnit', ''))
         self.add_path('/Shape', 0)
 
-        # Use the global MQTT client passed in
-        self.mqtt_client = mqtt_client
-
-        self.dbus_path_to_state_topic_map = {}
         self.is_level_direct = False
-
-        def is_valid_topic(topic):
-            return topic and 'path/to/mqtt' not in topic
+        self._handlers = {} # D-Bus path -> level handler, fixed by which level topic is configured
 
         level_topic = self.device_config.get('LevelStateTopic')
         raw_topic = self.device_config.get('RawValueStateTopic')
 
         if is_valid_topic(raw_topic):
             self.dbus_path_to_state_topic_map['/RawValue'] = raw_topic
-            logger.debug(f"Tank '{self['/CustomName']}' will use RawValue topic: {raw_topic}")
+            self._handlers['/RawValue'] = self._handle_raw_value
+            logger.debug(f"Tank '{self._custom_name}' will use RawValue topic: {raw_topic}")
         elif is_valid_topic(level_topic):
             self.is_level_direct = True
             self.dbus_path_to_state_topic_map['/Level'] = level_topic
-            logger.debug(f"Tank '{self['/CustomName']}' will use direct Level topic: {level_topic}")
+            self._handlers['/Level'] = self._handle_level_value
+            logger.debug(f"Tank '{self._custom_name}' will use direct Level topic: {level_topic}")
         else:
-            logger.warning(f"Tank '{self['/CustomName']}': Neither RawValueStateTopic nor LevelStateTopic are valid. Tank level will not update from MQTT.")
-        
-        # Add other topics if they exist and create their D-Bus paths
-        temp_topic = self.device_config.get('TemperatureStateTopic')
-        if is_valid_topic(temp_topic):
-            self.add_path('/Temperature', 0.0)
-            self.dbus_path_to_state_topic_map['/Temperature'] = temp_topic
-            logger.debug(f"Tank '{self['/CustomName']}' also subscribing to Temperature topic: {temp_topic}")
-        
-        battery_topic = self.device_config.get('BatteryStateTopic')
-        if is_valid_topic(battery_topic):
-            self.add_path('/BatteryVoltage', 0.0)
-            self.dbus_path_to_state_topic_map['/BatteryVoltage'] = battery_topic
-            logger.debug(f"Tank '{self['/CustomName']}' also subscribing to BatteryVoltage topic: {battery_topic}")
-
-        self.mqtt_subscriptions = set(self.dbus_path_to_state_topic_map.values()) # Store topics this instance cares about
-        for topic in self.mqtt_subscriptions:
-            logger.debug(f"DbusTankSensor '{self['/CustomName']}' will subscribe to topic: {topic}")
-
-        self.register() # Register D-Bus paths
-
-        logger.info(f"Service '{service_name}' for device '{self['/CustomName']}' registered on D-Bus.") 
-
-        # Initial calculations
-        if not self.is_level_direct:
-            self._calculate_level_from_raw_value()
-        self._calculate_remaining_from_level()
-
-    # Specific message handler for this tank sensor
-    def on_mqtt_message_specific(self, client, userdata, msg):
-        if msg.topic not in self.mqtt_subscriptions:
-            return # Not for this instance
-
-        logger.debug(f"DbusTankSensor specific MQTT callback triggered for {self['/CustomName']} on topic '{msg.topic}'")
-        try:
-            payload_str = msg.payload.decode().strip()
-            topic = msg.topic
-            dbus_path = next((k for k, v in self.dbus_path_to_state_topic_map.items() if v == topic), None)
-            if not dbus_path: 
-                logger.debug(f"DbusTankSensor: Received message on non-matching topic '{msg.topic}'. Not mapped for this sensor.")
-                return
-
-            value = None
-            try:
-                incoming_json = json.loads(payload_str)
-                if isinstance(incoming_json, dict) and "value" in incoming_json:
-                    value = float(incoming_json["value"])
-                else:
-                    logger.warning(f"DbusTankSensor: JSON payload for topic '{topic}' does not contain 'value' key or is not a dict.")
-                    return
-            except json.JSONDecodeError:
-                try: value = float(payload_str)
-                except ValueError: 
-                    logger.warning(f"DbusTankSensor: Payload '{payload_str}' for topic '{topic}' is not valid float or JSON.")
-                    return
-            
-            if value is None: 
-                logger.warning(f"DbusTankSensor: Could not extract valid numerical value from payload '{payload_str}' for topic '{topic}'.")
-                return
-            
-            if dbus_path == '/RawValue' and not self.is_level_direct:
-                if self['/RawValue'] != value:
-                    logger.debug(f"DbusTankSensor: Updating /RawValue to {value} and recalculating for '{self['/CustomName']}'.")
-                    GLib.idle_add(self._update_raw_value_and_recalculate, value)
-                else:
-                    logger.debug(f"DbusTankSensor: /RawValue already {value}. No update needed.")
-            elif dbus_path == '/Level' and self.is_level_direct:
-                if 0.0 <= value <= 100.0 and self['/Level'] != round(value, 2):
-                    logger.debug(f"DbusTankSensor: Updating /Level to {value} and recalculating for '{self['/CustomName']}'.")
-                    GLib.idle_add(self._update_level_and_recalculate, value)
-                else:
-                    logger.debug(f"DbusTankSensor: /Level already {value} or value out of range. No update needed.")
-            else: # For /Temperature or /BatteryVoltage
-                if self[dbus_path] != value:
-                    logger.debug(f"DbusTankSensor: Updating D-Bus path '{dbus_path}' to {value} for '{self['/CustomName']}'.")
-                    GLib.idle_add(self.update_dbus_from_mqtt, dbus_path, value)
-                else:
-                    logger.debug(f"DbusTankSensor: D-Bus path '{dbus_path}' already {value}. No update needed.")
-
-        except Exception as e:
-            logger.error(f"Error processing MQTT message for Tank {self.service_name} on topic {msg.topic}: {e}")
-            traceback.print_exc()
+            logger.warning(f"Tank '{self._custom_name}': Neither RawValueStateTopic nor LevelStateTopic are valid. Tank level will not update from MQTT.")
+
+    def handle_mqtt_value(self, dbus_path, value):
+        handler = self._handlers.get(dbus_path)
+        if handler:
+            handler(value)
+        else: # For /Temperature or /BatteryVoltage
+            super().handle_mqtt_value(dbus_path, value)
+
+    def _handle_raw_value(self, value):
+        if self._items['/RawValue'].local_get_value() != value:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"DbusTankSensor: Updating /RawValue to {value} and recalculating for '{self._custom_name}'.")
+            self.update_queue.schedule('__raw__', self._update_raw_value_and_recalculate, value)
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"DbusTankSensor: /RawValue already {value}. No update needed.")
+
+    def _handle_level_value(self, value):
+        if 0.0 <= value <= 100.0 and self._items['/Level'].local_get_value() != _r2(value):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"DbusTankSensor: Updating /Level to {value} and recalculating for '{self._custom_name}'.")
+            self.update_queue.schedule('__level__', self._update_level_and_recalculate, value)
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"DbusTankSensor: /Level already {value} or value out of range. No update needed.")
 
     def _update_raw_value_and_recalculate(self, raw_value):
         self['/RawValue'] = raw_value
@@ -759,38 +1019,53 @@ class DbusTankSensor(VeDbusService):
 
     def _update_level_and_recalculate(self, level_value):
         if 0.0 <= level_value <= 100.0:
-            self['/Level'] = round(level_value, 2)
+            self['/Level'] = _r2(level_value)
             self._calculate_remaining_from_level()
         return False
 
+    def _set_raw_calibration(self, raw_empty, raw_full):
+        self._raw_empty = float(raw_empty)
+        self._raw_full = float(raw_full)
+        # Percent per raw unit; 0.0 when uncalibrated so the level stays at 0
+        self._raw_scale = 100.0 / (self._raw_full - self._raw_empty) if self._raw_full != self._raw_empty else 0.0
+
     def _calculate_level_from_raw_value(self):
-        raw_value = self['/RawValue']
-        raw_empty = self['/RawValueEmpty']
-        raw_full = self['/RawValueFull']
-        level = 0.0
-        if raw_full != raw_empty:
-            level = ((raw_value - raw_empty) / (raw_full - raw_empty)) * 100.0
-            level = max(0.0, min(100.0, level))
-        self['/Level'] = round(level, 2)
-        logger.debug(f"Tank '{self['/CustomName']}' calculated Level: {self['/Level']}")
+        level = (self['/RawValue'] - self._raw_empty) * self._raw_scale
+        if level < 0.0:
+            level = 0.0
+        elif level > 100.0:
+            level = 100.0
+        self['/Level'] = _r2(level)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Tank '{self._custom_name}' calculated Level: {self['/Level']}")
 
     def _calculate_remaining_from_level(self):
-        remaining = (self['/Level'] / 100.0) * self['/Capacity']
-        self['/Remaining'] = round(remaining, 2)
-        logger.debug(f"Tank '{self['/CustomName']}' calculated Remaining: {self['/Remaining']}")
+        self['/Remaining'] = _r2(self['/Level'] * 0.01 * self._capacity)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Tank '{self._custom_name}' calculated Remaining: {self['/Remaining']}")
+
 
 
     def handle_dbus_change(self, path, value):
-        section_name = f'Tank_Sensor_{self.device_index}'
         key_name = path.split('/')[-1]
         
         value_to_save = value
-        if key_name == 'FluidType':
+        if path == '/CustomName':
+            self._custom_name = value
+        elif key_name == 'FluidType':
             # Convert integer back to string for saving to config
-            value_to_save = next((k for k, v in self.FLUID_TYPES.items() if v == value), 'fresh water')
-            logger.debug(f"Tank: Converting FluidType {value} to string '{value_to_save}' for saving.")
+            value_to_save = self.FLUID_TYPES_REV.get(value, 'fresh water')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Tank: Converting FluidType {value} to string '{value_to_save}' for saving.")
 
-        self.save_config_change(section_name, key_name, value_to_save)
+        self.save_config_change(self.section_name, key_name, value_to_save)
+
+        if path == '/RawValueEmpty':
+            self._set_raw_calibration(value, self._raw_full)
+        elif path == '/RawValueFull':
+            self._set_raw_calibration(self._raw_empty, value)
+        elif path == '/Capacity':
+            self._capacity = float(value)
 
         if path in ['/RawValueEmpty', '/RawValueFull'] and not self.is_level_direct:
             GLib.idle_add(self._calculate_level_from_raw_value)
@@ -800,290 +1075,103 @@ class DbusTankSensor(VeDbusService):
         
         return True
 
-    def save_config_change(self, section, key, value):
-        config = configparser.ConfigParser()
-        try:
-            config.read(CONFIG_FILE_PATH)
-            if not config.has_section(section): config.add_section(section)
-            config.set(section, key, str(value))
-            with open(CONFIG_FILE_PATH, 'w') as f:
-                config.write(f)
-            logger.debug(f"Saved config: Section=[{section}], Key='{key}', Value='{value}'")
-        except Exception as e:
-            logger.error(f"Failed to save config change for Tank: {e}")
-            traceback.print_exc()
-
-    def update_dbus_from_mqtt(self, path, value):
-        self[path] = value
-        return False
-
 # ====================================================================
 # DbusBattery Class
 # ====================================================================
-class DbusBattery(VeDbusService):
-    def __init__(self, service_name, device_config, serial_number, mqtt_client, bus):
-        # Pass the bus instance to the parent constructor
-        super().__init__(service_name, bus=bus, register=False)
-        self.device_config = device_config
-        self.device_index = device_config.getint('DeviceIndex')
-        self.service_name = service_name # Store service_name for logging
-
-        self.add_path('/Mgmt/ProcessName', 'dbus-victron-virtual')
-        self.add_path('/Mgmt/ProcessVersion', '0.1.19')
-        self.add_path('/Mgmt/Connection', 'Virtual')
-        
-        self.add_path('/DeviceInstance', self.device_config.getint('DeviceInstance'))
-        self.add_path('/ProductId', 49253)
-        self.add_path('/ProductName', 'Virtual battery')
-        self.add_path('/CustomName', self.device_config.get('CustomName'), writeable=True, onchangecallback=self.handle_dbus_change)
-        self.add_path('/Serial', serial_number)
-        
+class DbusBattery(DbusMqttServiceBase):
+    PRODUCT_ID = 49253
+    PRODUCT_NAME = 'Virtual battery'
+    SECTION_PREFIX = 'Virtual_Battery'
+
+    TOPIC_SPEC = (
+        ('/Soc', 'SocStateTopic', 0.0),
+        ('/Soh', 'SohStateTopic', 100.0),
+        ('/Dc/0/Current', 'CurrentStateTopic', 0.0),
+        ('/Dc/0/Power', 'PowerStateTopic', 0.0),
+        ('/Dc/0/Temperature', 'TemperatureStateTopic', 25.0),
+        ('/Dc/0/Voltage', 'VoltageStateTopic', 0.0)
+    )
+    # The high-rate battery telemetry topics
+    NUMERIC_PATHS = frozenset({'/Dc/0/Current', '/Dc/0/Power', '/Dc/0/Voltage', '/Soc', '/Soh'})
+
+    def add_device_paths(self):
         self.add_path('/Connected', 1)
-        self.add_path('/Soc', 0.0)
-        self.add_path('/Soh', 100.0)
         self.add_path('/Capacity', self.device_config.getfloat('CapacityAh'), writeable=True, onchangecallback=self.handle_dbus_change)
-        self.add_path('/Dc/0/Current', 0.0)
-        self.add_path('/Dc/0/Power', 0.0)
-        self.add_path('/Dc/0/Temperature', 25.0)
-        self.add_path('/Dc/0/Voltage', 0.0)
-        
+
         # Other paths
         self.add_path('/ErrorCode', 0)
         self.add_path('/Info/MaxChargeCurrent', None)
         self.add_path('/Info/MaxDischargeCurrent', None)
         self.add_path('/Info/MaxChargeVoltage', None)
 
-        # Use the global MQTT client passed in
-        self.mqtt_client = mqtt_client
-        
-        self.dbus_path_to_state_topic_map = {
-            '/Dc/0/Current': self.device_config.get('CurrentStateTopic'),
-            '/Dc/0/Power': self.device_config.get('PowerStateTopic'),
-            '/Dc/0/Temperature': self.device_config.get('TemperatureStateTopic'),
-            '/Dc/0/Voltage': self.device_config.get('VoltageStateTopic'),
-            '/Soc': self.device_config.get('SocStateTopic'),
-            '/Soh': self.device_config.get('SohStateTopic'),
-        }
-        self.dbus_path_to_state_topic_map = {k: v for k, v in self.dbus_path_to_state_topic_map.items() if v and 'path/to/mqtt' not in v}
-        
-        self.mqtt_subscriptions = set(self.dbus_path_to_state_topic_map.values()) # Store topics this instance cares about
-        for topic in self.mqtt_subscriptions:
-            logger.debug(f"DbusBattery '{self['/CustomName']}' will subscribe to topic: {topic}")
-
-        self.register() # Register D-Bus paths
-
-        logger.info(f"Service '{service_name}' for device '{self['/CustomName']}' registered on D-Bus.")
-
-    # Specific message handler for this battery
-    def on_mqtt_message_specific(self, client, userdata, msg):
-        if msg.topic not in self.mqtt_subscriptions:
-            return # Not for this instance
-
-        logger.debug(f"DbusBattery specific MQTT callback triggered for {self['/CustomName']} on topic '{msg.topic}'")
-        try:
-            payload_str = msg.payload.decode().strip()
-            topic = msg.topic
-            dbus_path = next((k for k, v in self.dbus_path_to_state_topic_map.items() if v == topic), None)
-            if not dbus_path: 
-                logger.debug(f"DbusBattery: Received message on non-matching topic '{msg.topic}'. Not mapped for this battery.")
-                return
-
-            value = None
-            try:
-                incoming_json = json.loads(payload_str)
-                if isinstance(incoming_json, dict) and "value" in incoming_json:
-                    value = incoming_json["value"]
-                else:
-                    logger.warning(f"DbusBattery: JSON payload for topic '{topic}' does not contain 'value' key or is not a dict.")
-                    return
-            except json.JSONDecodeError:
-                try: value = float(payload_str)
-                except ValueError: 
-                    logger.warning(f"DbusBattery: Payload '{payload_str}' for topic '{topic}' is not valid float or JSON.")
-                    return
-            
-            if value is None: 
-                logger.warning(f"DbusBattery: Could not extract valid numerical value from payload '{payload_str}' for topic '{topic}'.")
-                return
-            
-            if self[dbus_path] != value:
-                logger.debug(f"DbusBattery: Updating D-Bus path '{dbus_path}' to {value} for '{self['/CustomName']}'.")
-                GLib.idle_add(self.update_dbus_from_mqtt, dbus_path, value)
-            else:
-                logger.debug(f"DbusBattery: D-Bus path '{dbus_path}' already {value}. No update needed.")
-            
-        except Exception as e:
-            logger.error(f"Error processing MQTT message for Battery {self.service_name} on topic {msg.topic}: {e}")
-            traceback.print_exc()
-
     def handle_dbus_change(self, path, value):
-        section_name = f'Virtual_Battery_{self.device_index}'
-        if path == '/CustomName':
-            self.save_config_change(section_name, 'CustomName', value)
+        if path == '/Capacity':
+            self.save_config_change(self.section_name, 'CapacityAh', value)
             return True
-        elif path == '/Capacity':
-            self.save_config_change(section_name, 'CapacityAh', value)
-            return True
-        return False
-
-    def save_config_change(self, section, key, value):
-        config = configparser.ConfigParser()
-        try:
-            config.read(CONFIG_FILE_PATH)
-            if not config.has_section(section): config.add_section(section)
-            config.set(section, key, str(value))
-            with open(CONFIG_FILE_PATH, 'w') as f:
-                config.write(f)
-            logger.debug(f"Saved config: Section=[{section}], Key='{key}', Value='{value}'")
-        except Exception as e:
-            logger.error(f"Failed to save config change for Battery: {e}")
-            traceback.print_exc()
-            
-    def update_dbus_from_mqtt(self, path, value):
-        self[path] = value
-        return False
+        return super().handle_dbus_change(path, value)
 
 # ====================================================================
 # DbusPvCharger Class (NEW)
 # ====================================================================
-class DbusPvCharger(VeDbusService):
-    def __init__(self, service_name, device_config, serial_number, mqtt_client, bus):
-        super().__init__(service_name, bus=bus, register=False)
-        self.device_config = device_config
-        self.device_index = device_config.getint('DeviceIndex')
-        self.service_name = service_name
-
-        self.add_path('/Mgmt/ProcessName', 'dbus-victron-virtual')
-        self.add_path('/Mgmt/ProcessVersion', '0.0.1')
-        self.add_path('/Mgmt/Connection', 'Virtual')
-
-        self.add_path('/DeviceInstance', self.device_config.getint('DeviceInstance'))
-        self.add_path('/ProductId', 41318)
-        self.add_path('/ProductName', 'Virtual MPPT')
-        self.add_path('/CustomName', self.device_config.get('CustomName'), writeable=True, onchangecallback=self.handle_dbus_change)
-        self.add_path('/Serial', serial_number)
-
-        self.add_path('/Connected', 1)
+# Plain-text state names accepted on the charger and load state topics, keyed by payload bytes
+CHARGER_STATE_MAP = MappingProxyType({b'off': 0, b'bulk': 3, b'absorption': 4, b'float': 5})
+LOAD_STATE_MAP = MappingProxyType({b'off': 0, b'on': 1})
+
+def state_name_parser(name_map):
+    # Parser for state topics carrying a state name, plain (b'bulk') or as a JSON "value" ({"value": "bulk"});
+    # returns None for anything else so numeric payloads fall through to parse_mqtt_value()
+    def parse(payload):
+        payload = payload.strip()
+        state = name_map.get(payload.lower())
+        if state is None and payload[:1] == b'{':
+            try:
+                incoming_json = json_loads(payload)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                return None
+            if isinstance(incoming_json, dict):
+                value = incoming_json.get("value")
+                if isinstance(value, str):
+                    state = name_map.get(value.strip().lower().encode())
+        return state
+    return parse
+
+class DbusPvCharger(DbusMqttServiceBase):
+    PRODUCT_ID = 41318
+    PRODUCT_NAME = 'Virtual MPPT'
+    PROCESS_VERSION = '0.0.1'
+    SECTION_PREFIX = 'Pv_Charger'
+    # State topics usually carry state names, so try the name lookup before numeric/JSON parsing
+    PATH_PARSERS = {
+        '/State': state_name_parser(CHARGER_STATE_MAP),
+        '/Load/State': state_name_parser(LOAD_STATE_MAP)
+    }
 
+    TOPIC_SPEC = (
         # DC Paths
-        self.add_path('/Dc/0/Current', 0.0)
-        self.add_path('/Dc/0/Voltage', 0.0)
-
+        ('/Dc/0/Current', 'BatteryCurrentStateTopic', 0.0),
+        ('/Dc/0/Voltage', 'BatteryVoltageStateTopic', 0.0),
         # Link Paths
-        self.add_path('/Link/ChargeVoltage', None)
-        self.add_path('/Link/ChargeCurrent', None)
-
+        ('/Link/ChargeVoltage', 'MaxChargeVoltageStateTopic', None),
+        ('/Link/ChargeCurrent', 'MaxChargeCurrentStateTopic', None),
         # Load Path
-        self.add_path('/Load/State', None)
-        
-        # Charger State
-        self.add_path('/State', 0) # 0=Off, 3=Bulk, 4=Absorption, 5=Float
-
+        ('/Load/State', 'LoadStateTopic', None),
+        # Charger State: 0=Off, 3=Bulk, 4=Absorption, 5=Float
+        ('/State', 'ChargerStateTopic', 0),
         # PV Paths
-        self.add_path('/Pv/V', 0.0)
-        self.add_path('/Yield/Power', 0.0)
-        self.add_path('/Yield/User', 0.0)
-        self.add_path('/Yield/System', 0.0)
-        
-        self.mqtt_client = mqtt_client
-
-        self.dbus_path_to_state_topic_map = {
-            '/Dc/0/Current': self.device_config.get('BatteryCurrentStateTopic'),
-            '/Dc/0/Voltage': self.device_config.get('BatteryVoltageStateTopic'),
-            '/Link/ChargeVoltage': self.device_config.get('MaxChargeVoltageStateTopic'),
-            '/Link/ChargeCurrent': self.device_config.get('MaxChargeCurrentStateTopic'),
-            '/Load/State': self.device_config.get('LoadStateTopic'),
-            '/State': self.device_config.get('ChargerStateTopic'),
-            '/Pv/V': self.device_config.get('PvVoltageStateTopic'),
-            '/Yield/Power': self.device_config.get('PvPowerStateTopic'),
-            '/Yield/User': self.device_config.get('TotalYield'),
-            '/Yield/System': self.device_config.get('SystemYield')
-        }
-        self.dbus_path_to_state_topic_map = {k: v for k, v in self.dbus_path_to_state_topic_map.items() if v and 'path/to/mqtt' not in v}
-
-        self.mqtt_subscriptions = set(self.dbus_path_to_state_topic_map.values()) # Store topics this instance cares about
-        for topic in self.mqtt_subscriptions:
-            logger.debug(f"DbusPvCharger '{self['/CustomName']}' will subscribe to topic: {topic}")
+        ('/Pv/V', 'PvVoltageStateTopic', 0.0),
+        ('/Yield/Power', 'PvPowerStateTopic', 0.0),
+        ('/Yield/User', 'TotalYield', 0.0),
+        ('/Yield/System', 'SystemYield', 0.0)
+    )
 
-        self.register()
-
-        logger.info(f"Service '{service_name}' for device '{self['/CustomName']}' registered on D-Bus.")
-
-    def on_mqtt_message_specific(self, client, userdata, msg):
-        # Check if the topic is one this instance is interested in
-        if msg.topic not in self.mqtt_subscriptions:
-            return # Not for this instance
-
-        logger.debug(f"DbusPvCharger specific MQTT callback triggered for {self['/CustomName']} on topic '{msg.topic}'")
-        try:
-            payload_str = msg.payload.decode().strip()
-            topic = msg.topic
-            dbus_path = next((k for k, v in self.dbus_path_to_state_topic_map.items() if v == topic), None)
-            if not dbus_path:
-                return
-
-            value = None
-            try:
-                # Attempt to parse as JSON with a "value" key
-                incoming_json = json.loads(payload_str)
-                if isinstance(incoming_json, dict) and "value" in incoming_json:
-                    value = incoming_json["value"]
-                else: # Fallback for plain numeric JSON
-                    value = float(payload_str)
-            except (json.JSONDecodeError, ValueError):
-                # If not JSON, handle as plain string or number
-                if dbus_path == '/State':
-                    state_map = {'off': 0, 'bulk': 3, 'absorption': 4, 'float': 5}
-                    try: value = int(payload_str)
-                    except ValueError: value = state_map.get(payload_str.lower())
-                elif dbus_path == '/Load/State':
-                    state_map = {'off': 0, 'on': 1}
-                    try: value = int(payload_str)
-                    except ValueError: value = state_map.get(payload_str.lower())
-                else:
-                    try: value = float(payload_str)
-                    except ValueError:
-                        logger.warning(f"DbusPvCharger: Payload '{payload_str}' for topic '{topic}' is not a valid float or recognized state string.")
-                        return
-
-            if value is None:
-                logger.warning(f"DbusPvCharger: Could not extract a valid value from payload '{payload_str}' for topic '{topic}'.")
-                return
-
-            if self[dbus_path] != value:
-                logger.debug(f"DbusPvCharger: Updating D-Bus path '{dbus_path}' to {value} for '{self['/CustomName']}'.")
-                GLib.idle_add(self.update_dbus_from_mqtt, dbus_path, value)
-
-        except Exception as e:
-            logger.error(f"Error processing MQTT message for PV Charger {self.service_name} on topic {msg.topic}: {e}")
-            traceback.print_exc()
-
-    def handle_dbus_change(self, path, value):
-        section_name = f'Pv_Charger_{self.device_index}'
-        if path == '/CustomName':
-            self.save_config_change(section_name, 'CustomName', value)
-            return True
-        return False
-
-    def save_config_change(self, section, key, value):
-        config = configparser.ConfigParser()
-        try:
-            config.read(CONFIG_FILE_PATH)
-            if not config.has_section(section):
-                config.add_section(section)
-            config.set(section, key, str(value))
-            with open(CONFIG_FILE_PATH, 'w') as f:
-                config.write(f)
-            logger.debug(f"Saved config: Section=[{section}], Key='{key}', Value='{value}'")
-        except Exception as e:
-            logger.error(f"Failed to save config change for PV Charger: {e}")
-            traceback.print_exc()
+    def add_device_paths(self):
+        self.add_path('/Connected', 1)
 
     def update_dbus_from_mqtt(self, path, value):
         if isinstance(value, (float, int)):
-            self[path] = round(value, 2)
+            self._items[path].local_set_value(_r2(value))
         else:
-            self[path] = value
+            self._items[path].local_set_value(value)
         return False
 
 # ====================================================================
@@ -1096,24 +1184,34 @@ def on_mqtt_connect_global(client, userdata, flags, rc, properties):
         # Userdata should contain the set of topics to subscribe to
         if userdata:
             logger.info("Re-subscribing to topics...")
-            for topic in userdata:
-                client.subscribe(topic)
-                logger.debug(f"Subscribed to topic: {topic}")
+            # One SUBSCRIBE packet for all topics instead of one round-trip per topic
+            client.subscribe([(topic, 0) for topic in userdata])
+            logger.debug(f"Subscribed to {len(userdata)} topics: {', '.join(sorted(userdata))}")
     else:
         logger.error(f"Failed to connect to MQTT Broker, return code {rc}")
 
 # --- Global MQTT Message Dispatcher ---
 def on_mqtt_message_dispatcher(client, userdata, msg):
-    logger.debug(f"GLOBAL MQTT MESSAGE RECEIVED: Topic='{msg.topic}', Payload='{msg.payload.decode()}'")
-    # Iterate through all active services and dispatch the message
-    for service in active_services:
-        # Each service will internally check if the message is relevant to its subscriptions
-        service.on_mqtt_message_specific(client, userdata, msg)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"GLOBAL MQTT MESSAGE RECEIVED: Topic='{msg.topic}', Payload='{msg.payload.decode(errors='replace')}'")
+    # Parsing and routing happen on the worker thread
+    mqtt_message_worker.put(msg)
+
+def register_mqtt_routes(service):
+    # Topics can be shared between devices, so each topic routes to a list of handlers.
+    # Each handler has its D-Bus path bound in already, so a message is just handler(msg).
+    for topic, dbus_path in service.mqtt_routes():
+        MQTT_ROUTES.setdefault(topic, []).append(functools.partial(service.handle_mqtt_message, dbus_path))
 
 # --- ADDED: Global MQTT Disconnect Callback ---
 def on_mqtt_disconnect(client, userdata, rc, properties=None, reason=None): # Added properties and reason
     logger.warning(f"MQTT client disconnected with result code: {rc}, Reason: {reason}")
 
+# --- Global MQTT Connect Failure Callback ---
+def on_mqtt_connect_fail(client, userdata):
+    # Called by the network loop for each reconnect attempt that can't reach the broker; it retries with backoff
+    logger.error(f"Could not reach MQTT broker at {client.host}:{client.port}. Retrying with backoff.")
+
 # --- ADDED: Global MQTT Subscribe Callback ---
 def on_mqtt_subscribe(client, userdata, mid, granted_qos, properties=None):
     logger.debug(f"MQTT Subscription acknowledged by broker. Message ID: {mid}, Granted QoS: {granted_qos}")
@@ -1123,11 +1221,39 @@ def on_mqtt_subscribe(client, userdata, mid, granted_qos, properties=None):
 # Main Launcher (Refactored to run all services in one process)
 # ====================================================================
 
-# Make active_services a global list so the dispatcher can access it
+# Services created by main(); messages reach them through MQTT_ROUTES
 active_services = []
+# MQTT topic -> list of handler(msg) callables, filled as services are created
+MQTT_ROUTES = {}
+# Outgoing messages paho may hold while waiting for in-flight slots; publishes beyond this fail with MQTT_ERR_QUEUE_SIZE
+MQTT_MAX_QUEUED_MESSAGES = 20
+# Handles messages handed over by on_mqtt_message_dispatcher
+mqtt_message_worker = MqttMessageWorker()
+
+# [switch_X_Y] sections are outputs of their parent Relay_Module, not devices of their own
+SWITCH_OUTPUT_SECTION_RE = re.compile(r'^switch_\d+_\d+$')
+# Device sections by lowercased name: group 1 is the device type, group 2 the device index
+DEVICE_SECTION_RE = re.compile(r'^(relay_module|temp_sensor|tank_sensor|virtual_battery|input|pv_charger)_(\d+)')
+DEVICE_CLASS_BY_TYPE = {
+    'relay_module': DbusSwitch,
+    'temp_sensor': DbusTempSensor,
+    'tank_sensor': DbusTankSensor,
+    'virtual_battery': DbusBattery,
+    'input': DbusDigitalInput,
+    'pv_charger': DbusPvCharger # Added PV Charger
+}
+# Service type used in the D-Bus service name (com.victronenergy.<type>.external_<serial>) per device type
+SERVICE_TYPE_BY_DEVICE_TYPE = {
+    'relay_module': 'switch',
+    'temp_sensor': 'temperature',
+    'tank_sensor': 'tank',
+    'virtual_battery': 'battery',
+    'input': 'digitalinput',
+    'pv_charger': 'solarcharger'
+}
 
 def main():
-    global active_services # Make active_services a global list so the dispatcher can access it
+    global active_services
 
     logger.info("Starting D-Bus Virtual Devices main service.")
     
@@ -1135,13 +1261,14 @@ def main():
     from dbus.mainloop.glib import DBusGMainLoop
     DBusGMainLoop(set_as_default=True)
 
-    config = configparser.ConfigParser()
     if not os.path.exists(CONFIG_FILE_PATH):
         logger.critical(f"Config file not found: {CONFIG_FILE_PATH}")
         sys.exit(1)
     
     try:
-        config.read(CONFIG_FILE_PATH)
+        config = load_config(CONFIG_FILE_PATH)
+        # Snapshot the file for saving D-Bus changes now, from the same parse and before DeviceIndex is injected below
+        config_store.load(config)
     except configparser.Error as e:
         logger.critical(f"Error parsing config file: {e}")
         sys.exit(1)
@@ -1175,6 +1302,14 @@ def main():
     mqtt_client.on_message = on_mqtt_message_dispatcher
     mqtt_client.on_subscribe = on_mqtt_subscribe
     mqtt_client.on_disconnect = on_mqtt_disconnect
+    mqtt_client.on_connect_fail = on_mqtt_connect_fail
+    # Reconnect with exponential backoff (doubling up to 5 minutes); the random start spreads out
+    # devices that all lost the same broker, so they don't reconnect in lockstep
+    mqtt_client.reconnect_delay_set(min_delay=1 + random.random(), max_delay=300)
+    # Let bursts of QoS 1/2 commands go out without waiting for acks one by one, but keep the outgoing
+    # queue small so commands can't pile up for a late replay (paho's default of 0 means unbounded)
+    mqtt_client.max_inflight_messages_set(100)
+    mqtt_client.max_queued_messages_set(MQTT_MAX_QUEUED_MESSAGES)
     
     if MQTT_USERNAME and MQTT_PASSWORD:
         mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
@@ -1182,46 +1317,26 @@ def main():
     
     # MODIFICATION: Connection logic is MOVED to after the device setup loop.
 
-    device_type_map = {
-        'relay_module_': DbusSwitch,
-        'temp_sensor_': DbusTempSensor,
-        'tank_sensor_': DbusTankSensor,
-        'virtual_battery_': DbusBattery,
-        'input_': DbusDigitalInput,
-        'pv_charger_': DbusPvCharger # Added PV Charger
-    }
+    # Section names collected once, so each Relay_Module's switch outputs are found by set membership
+    all_sections = set(config.sections())
 
-    sections_to_process = []
     for section in config.sections():
         section_lower = section.lower()
-        if section_lower in ['global', 'mqtt']:
+        if section_lower in ('global', 'mqtt'):
             continue
         # RE-ENABLED: This correctly skips [switch_X_Y] sections from being processed as top-level devices
-        if section_lower.startswith('switch_') and re.match(r'^switch_\d+_\d+$', section_lower):
+        if SWITCH_OUTPUT_SECTION_RE.match(section_lower):
             logger.debug(f"Section '{section}' appears to be a switch output configuration. It will be processed by its parent Relay_Module. Skipping direct device creation.")
             continue
-        sections_to_process.append(section)
 
-
-    for section in sections_to_process:
-        section_lower = section.lower()
-        device_class = None
-        device_type_string = None 
-
-        for prefix, cls in device_type_map.items():
-            if section_lower.startswith(prefix): # This is the key comparison for identifying the device type
-                device_class = cls
-                device_type_string = prefix.strip('_')
-                logger.debug(f"Section '{section}' matched device type '{device_type_string}' (prefix '{prefix}').")
-                break
-        
-        if device_class:
+        # One match gives both the device type and its index
+        device_match = DEVICE_SECTION_RE.match(section_lower)
+        if device_match:
+            device_type_string, device_index = device_match.groups()
+            device_class = DEVICE_CLASS_BY_TYPE[device_type_string]
+            logger.debug(f"Section '{section}' matched device type '{device_type_string}'.")
             try:
                 device_config = config[section]
-                
-                # Determine device_index for the current section
-                device_index_match = re.search(r'_(\d+)', section)
-                device_index = device_index_match.group(1) if device_index_match else '0'
                 device_config['DeviceIndex'] = device_index # Inject DeviceIndex into config for class access
 
                 serial_number = device_config.get('Serial')
@@ -1231,19 +1346,13 @@ def main():
                     logger.warning(f"Serial number not found or is empty for [{section}]. Generating random serial: {serial_number}")
 
                 # IMPORTANT: Create a NEW, independent BusConnection instance for each service
-                # This ensures each service gets its own D-Bus name.
+                # This ensures each service gets its own D-Bus name. Don't share one connection between
+                # services: VeDbusService exports '/' and its item paths on its connection, so a second
+                # service on the same connection would collide with the first one's object paths.
                 device_bus = dbus.bus.BusConnection(dbus.Bus.TYPE_SYSTEM)
                 
                 # Default service name uses 'external_' prefix and device type
-                base_service_name_type = device_type_string.replace("_", "")
-                if base_service_name_type == 'relaymodule': base_service_name_type = 'switch'
-                elif base_service_name_type == 'input': base_service_name_type = 'digitalinput'
-                elif base_service_name_type == 'tanksensor': base_service_name_type = 'tank'
-                elif base_service_name_type == 'tempsensor': base_service_name_type = 'temperature'
-                elif base_service_name_type == 'virtualbattery': base_service_name_type = 'battery'
-                elif base_service_name_type == 'pvcharger': base_service_name_type = 'solarcharger' # Added for PV Charger
-                
-                service_name = f'com.victronenergy.{base_service_name_type}.external_{serial_number}'
+                service_name = f'com.victronenergy.{SERVICE_TYPE_BY_DEVICE_TYPE[device_type_string]}.external_{serial_number}'
 
                 if device_class == DbusSwitch:
                     # This branch is now ONLY for Relay_Module_X sections (multi-output switch modules)
@@ -1258,7 +1367,7 @@ def main():
                     for j in range(1, num_switches + 1):
                         output_section_name = f'switch_{device_index}_{j}' # e.g., switch_1_1, switch_1_2
                         output_data = {'index': j, 'name': f'Switch {j}'} # Default name
-                        if config.has_section(output_section_name):
+                        if output_section_name in all_sections:
                             output_settings = config[output_section_name]
                             output_data.update({
                                 'custom_name': output_settings.get('CustomName', ''),
@@ -1278,6 +1387,7 @@ def main():
                     service = device_class(service_name, device_config, serial_number, mqtt_client, device_bus)
                 
                 active_services.append(service)
+                register_mqtt_routes(service)
                 logger.debug(f"Successfully initialized and registered D-Bus service for [{section}] of type '{device_type_string}'.")
 
                 # Collect topics to subscribe to centrally
@@ -1291,8 +1401,11 @@ def main():
 
     # MODIFICATION: Now that all topics are known, connect to the broker.
     # The on_connect callback will fire and subscribe to everything in the populated set.
+    # The first connect is blocking, so a wrong host or unreachable broker stops the service with the
+    # reason logged; once running, the network loop reconnects with the backoff set above.
     try:
         mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
+        mqtt_message_worker.start()
         mqtt_client.loop_start() # Start the MQTT network loop in a separate thread
         logger.info(f"Connecting to MQTT broker at {MQTT_HOST}:{MQTT_PORT}...")
     except Exception as e:
@@ -1311,6 +1424,8 @@ def main():
     
     # Keep the main loop running to maintain D-Bus services and MQTT client
     mainloop = GLib.MainLoop()
+    # Stop the loop on SIGTERM (service stop) so the delayed config flush below still runs
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, lambda: mainloop.quit() or False)
     try:
         mainloop.run()
     except KeyboardInterrupt:
@@ -1319,6 +1434,8 @@ def main():
         logger.error(f"An unexpected error occurred in the main loop: {e}")
         traceback.print_exc()
     finally:
+        # Write out any config changes still waiting for the delayed flush
+        config_store.flush()
         # Cleanup: Disconnect MQTT client cleanly
         if mqtt_client:
             mqtt_client.loop_stop()